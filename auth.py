@@ -13,13 +13,24 @@ def logout():
     cookie_manager = get_manager()
     # Clear cookies if manager is available
     if cookie_manager:
+        # 签名令牌本身无法作废，登出时加入吊销名单
+        token = cookie_manager.get("token")
+        if token:
+            storage.revoke_session_token(token, cookie_manager.get("username"))
         cookie_manager.delete("username")
         cookie_manager.delete("token")
     
     # Clear session state
     st.session_state.authenticated = False
     st.session_state.username = None
-    st.session_state.history = []
+    # 未写盘的设置先落盘
+    profile = st.session_state.pop("profile_cache", None)
+    if profile:
+        profile.flush()
+    
+    # 清掉聊天窗口和模型会话，下次登录重新加载
+    for key in ("history", "history_start", "history_window", "gemini_session"):
+        st.session_state.pop(key, None)
     
     # Rerun to show login screen
     st.rerun()
@@ -128,9 +139,6 @@ def auth_flow():
     if st.session_state.get("authenticated", False):
         return True
 
-    # Give a tiny bit of time for cookies to sync (hacky but effective for Streamlit)
-    time.sleep(0.1)
-
     # Try to authenticate via cookies
     try:
         # Use individual get calls for better reliability
@@ -138,12 +146,17 @@ def auth_flow():
         c_token = cookie_manager.get("token")
         
         if c_username and c_token:
-            if storage.verify_session_token(c_username, c_token):
+            # 签名令牌只做 HMAC 校验，不读用户表；校验通过直接进入，无需等待和重跑
+            token = storage.exchange_session_token(c_username, c_token)
+            if token:
+                if token != c_token:
+                    # 旧版令牌换成了签名令牌，更新 cookie (旧令牌已作废)
+                    expires = datetime.datetime.utcnow() + datetime.timedelta(days=30)
+                    cookie_manager.set("token", token, expires_at=expires, key="upgrade_set_token")
                 st.session_state.authenticated = True
                 st.session_state.username = c_username
                 st.toast(f"欢迎回来, {c_username} (自动登录)")
-                time.sleep(0.5)
-                st.rerun()
+                return True
     except Exception as e:
         # Ignore cookie errors
         # st.error(f"Cookie Error: {e}") # Debug only
@@ -0,0 +1,179 @@
+"""Micro-benchmarks for the persistence hot path and the J1800 bridge.
+
+    python benchmarks/bench_storage.py                      # json backend, default sizes
+    python benchmarks/bench_storage.py --backend sqlite --history 100 1000 10000 --concurrency 1 8
+    python benchmarks/bench_storage.py --json results.json  # machine-readable output for comparisons
+
+Runs against a throwaway data folder (trace spans from the bridge included); never touches ./data.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+import bridge_server
+import car_queue
+import tracing
+
+SAMPLE_TEXT = "今天天气不错，我们去公园散步吧。老贾你觉得呢？Let's also check the schedule. "
+
+def _written_bytes():
+    # Linux 下按进程统计 write 系统调用写出的字节数；其他平台返回 None
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def synthetic_message(i, image_ratio):
+    parts = [{"type": "text", "text": SAMPLE_TEXT * random.randint(1, 4)}]
+    if random.random() < image_ratio:
+        parts.append({"type": "image", "path": f"images/synthetic-{i}.jpg"})
+    return {"role": "user" if i % 2 == 0 else "model", "parts": parts}
+
+def seed_history(username, length, image_ratio):
+    storage.save_memory(username, [synthetic_message(i, image_ratio) for i in range(length)])
+
+def measure(name, fn, iterations, concurrency=1, **labels):
+    """Runs fn(i) iterations times split over `concurrency` threads; returns a result row"""
+    latencies = []
+    lock = threading.Lock()
+    
+    def worker(offset):
+        local = []
+        for i in range(offset, iterations, concurrency):
+            t0 = time.perf_counter()
+            fn(i)
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+    
+    written_before = _written_bytes()
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(k,)) for k in range(concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - t0
+    written_after = _written_bytes()
+    
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3)
+    return {
+        "op": name,
+        **labels,
+        "concurrency": concurrency,
+        "n": len(latencies),
+        "p50_ms": ms(tracing.percentile(latencies, 50)),
+        "p90_ms": ms(tracing.percentile(latencies, 90)),
+        "p99_ms": ms(tracing.percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1]) if latencies else 0.0,
+        "ops_per_s": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "bytes_per_op": (written_after - written_before) // max(1, len(latencies)) if written_before is not None else None,
+    }
+
+def bench_history(length, iterations, concurrency, image_ratio):
+    rows = []
+    users = [f"hist{length}_{k}" for k in range(concurrency)]
+    for user in users:
+        seed_history(user, length, image_ratio)
+    labels = {"history": length}
+    
+    # 每个线程写自己的用户，和线上一个会话一个用户的情况一致
+    def append(i):
+        storage.append_message(users[i % concurrency], synthetic_message(i, image_ratio))
+    rows.append(measure("append_message", append, iterations, concurrency, **labels))
+    
+    cached = {user: storage.load_memory(user) for user in users}
+    def save(i):
+        user = users[i % concurrency]
+        cached[user].append(synthetic_message(i, image_ratio))
+        storage.save_memory(user, cached[user])
+    rows.append(measure("save_memory", save, iterations, concurrency, **labels))
+    
+    rows.append(measure("load_memory", lambda i: storage.load_memory(users[i % concurrency]), max(1, iterations // 10), concurrency, **labels))
+    rows.append(measure("last_message", lambda i: storage.last_message(users[i % concurrency]), iterations, concurrency, **labels))
+    
+    # bridge: 旧版按用户取/还 + 新版队列
+    def bridge_get_put(i):
+        user = users[i % concurrency]
+        storage.append_message(user, {"role": "user", "parts": [SAMPLE_TEXT]})
+        if bridge_server.pending_question(user)["has_new"]:
+            bridge_server.put_reply(user, SAMPLE_TEXT)
+    rows.append(measure("bridge_get_put", bridge_get_put, iterations, concurrency, **labels))
+    
+    def queue_round_trip(i):
+        user = users[i % concurrency]
+        msg_id = storage.append_message(user, {"role": "user", "parts": [SAMPLE_TEXT]})
+        car_queue.enqueue(user, SAMPLE_TEXT, msg_id)
+        request = bridge_server.next_request(0)
+        if request["has_new"]:
+            bridge_server.complete_request(request["id"], SAMPLE_TEXT)
+    rows.append(measure("bridge_queue", queue_round_trip, iterations, concurrency, **labels))
+    return rows
+
+def bench_users(user_count, iterations, concurrency):
+    rows = []
+    existing = storage.init_storage().list_usernames()
+    for k in range(len(existing), user_count):
+        storage.create_user(f"user{k}", "password")
+    labels = {"users": user_count}
+    rows.append(measure("get_user", lambda i: storage.get_user(f"user{random.randrange(user_count)}"), iterations, concurrency, **labels))
+    rows.append(measure("verify_user", lambda i: storage.verify_user(f"user{random.randrange(user_count)}", "password"), iterations, concurrency, **labels))
+    rows.append(measure("create_user", lambda i: storage.create_user(f"new{user_count}_{concurrency}_{i}", "password"), max(1, iterations // 10), concurrency, **labels))
+    return rows
+
+def print_table(rows):
+    columns = ["op", "backend", "history", "users", "concurrency", "n", "p50_ms", "p90_ms", "p99_ms", "max_ms", "ops_per_s", "bytes_per_op"]
+    widths = {c: max(len(c), *(len(str(r.get(c, ""))) for r in rows)) for c in columns}
+    print("  ".join(c.ljust(widths[c]) for c in columns))
+    for r in rows:
+        print("  ".join(str(r.get(c, "")).ljust(widths[c]) for c in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--history", type=int, nargs="+", default=[10, 100, 1000], help="history lengths to test")
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000], help="registry sizes to test")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--image-ratio", type=float, default=0.1, help="fraction of messages carrying an image part")
+    parser.add_argument("--json", metavar="PATH", help="also write results as JSON")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary data folder")
+    args = parser.parse_args()
+    
+    random.seed(1800)
+    data_folder = tempfile.mkdtemp(prefix="laojia-bench-")
+    storage.configure(data_folder=data_folder, backend=args.backend)
+    # bridge 的 next_request / complete_request 会写 trace，一并放进临时目录
+    tracing.TRACE_FOLDER = os.path.join(data_folder, "traces")
+    rows = []
+    try:
+        for concurrency in args.concurrency:
+            for length in args.history:
+                rows += bench_history(length, args.iterations, concurrency, args.image_ratio)
+            for user_count in args.users:
+                rows += bench_users(user_count, args.iterations, concurrency)
+    finally:
+        if not args.keep:
+            shutil.rmtree(data_folder, ignore_errors=True)
+    
+    for row in rows:
+        row["backend"] = args.backend
+    print_table(rows)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+import os
+import hmac
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import storage
+import notify
+import car_queue
+import tracing
+
+# J1800 信箱的独立 JSON 接口，不经过 Streamlit 页面渲染
+# 队列里是所有用户的问题，回复会写进任意用户的记录：对外监听必须设置共享口令 (请求带 X-Bridge-Token 头)
+BRIDGE_TOKEN = os.environ.get("BRIDGE_TOKEN", "")
+# 没有口令时只监听本机
+BRIDGE_HOST = os.environ.get("BRIDGE_HOST", "0.0.0.0" if BRIDGE_TOKEN else "127.0.0.1")
+BRIDGE_PORT = int(os.environ.get("BRIDGE_PORT", "8502"))
+MAX_POLL_SECONDS = 30
+_LOOPBACK_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+_server = None
+_server_lock = threading.Lock()
+start_error = None # 最近一次启动失败的原因，界面据此提示车队模式不可用
+
+def pending_question(user):
+    """Returns the bridge payload for user's unanswered message, if the last message is from the user"""
+    last = storage.last_message(user)
+    if last and last["role"] == "user":
+        txt = storage.message_text(last)
+        if txt:
+            return {"has_new": True, "content": txt}
+    return {"has_new": False}
+
+def wait_for_question(user, timeout):
+    """Long-poll variant of pending_question: blocks until a question exists or timeout"""
+    def ready():
+        res = pending_question(user)
+        return res if res["has_new"] else None
+    return notify.wait_until(storage.memory_key(user), ready, timeout) or {"has_new": False}
+
+def is_open_question(user, msg_id):
+    """True if message msg_id is still user's last message, i.e. nothing has been said since"""
+    if msg_id is None:
+        last = storage.last_message(user)
+        return bool(last) and last["role"] == "user"
+    return storage.message_count(user) == msg_id + 1
+
+def put_reply(user, msg):
+    """Stores msg as the model's reply if user is still waiting for one"""
+    last = storage.last_message(user)
+    if last and last["role"] == "user":
+        storage.append_message(user, {"role": "model", "parts": [{"type": "text", "text": msg}]})
+        return True
+    return False
+
+def next_request(timeout):
+    """Leases the oldest queued question across all users (long-polls up to timeout)"""
+    request = car_queue.dequeue(timeout)
+    if request is None:
+        return {"has_new": False}
+    tracing.record(request["turn"], "bridge", "queue_wait", (request["leased_at"] - request["enqueued_at"]) * 1000)
+    return {"has_new": True, "id": request["id"], "user": request["user"], "content": request["content"], "turn": request["turn"]}
+
+def complete_request(req_id, msg, spans=None):
+    """Stores msg as the reply to queued request req_id, plus the bot's spans for that turn"""
+    request = car_queue.complete(req_id)
+    if request is None:
+        return False
+    # 网页端等不及时用户可能已经问了下一句；只有这个问题仍是最后一条消息时回复才算数，
+    # 否则旧问题的回答会被当成新问题的回答显示出来
+    if not is_open_question(request["user"], request["msg_id"]):
+        tracing.record(request["turn"], "bridge", "late_reply", (time.time() - request["leased_at"]) * 1000, ok=False)
+        return False
+    storage.append_message(request["user"], {"role": "model", "parts": [{"type": "text", "text": msg}]})
+    tracing.record(request["turn"], "bridge", "bot_roundtrip", (time.time() - request["leased_at"]) * 1000)
+    # J1800 本地的耗时记录随回复带回来，侧边栏的统计才能看到机器人那一侧
+    tracing.record_remote(request["turn"], "j1800", spans)
+    return True
+
+class BridgeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _authorized(self):
+        if BRIDGE_TOKEN and not hmac.compare_digest(self.headers.get("X-Bridge-Token", "").encode(), BRIDGE_TOKEN.encode()):
+            self._send_json(403, {"error": "forbidden"})
+            return False
+        return True
+
+    def _poll_timeout(self, query):
+        try:
+            return max(0, min(float(query.get("timeout", ["0"])[0]), MAX_POLL_SECONDS))
+        except ValueError:
+            return 0
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif url.path == "/next":
+            self._send_json(200, next_request(self._poll_timeout(query)))
+        elif url.path == "/stats":
+            self._send_json(200, car_queue.stats())
+        elif url.path == "/pending":
+            user = query.get("user", [""])[0]
+            if not user:
+                self._send_json(400, {"error": "missing user"})
+                return
+            timeout = self._poll_timeout(query)
+            self._send_json(200, wait_for_question(user, timeout) if timeout > 0 else pending_question(user))
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        url = urlparse(self.path)
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid json"})
+            return
+        if url.path == "/reply":
+            # 优先按请求 ID 回传；只带 user 的是旧版单用户协议
+            req_id, user, msg = payload.get("id"), payload.get("user"), payload.get("msg")
+            if not (req_id or user) or msg is None:
+                self._send_json(400, {"error": "missing id or msg"})
+                return
+            ok = complete_request(req_id, msg, payload.get("spans")) if req_id else put_reply(user, msg)
+            self._send_json(200, {"status": "success" if ok else "ignored"})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        # 轮询很频繁，不刷访问日志
+        pass
+
+def start_in_background(host=BRIDGE_HOST, port=BRIDGE_PORT):
+    """Starts the bridge server once per process on a daemon thread.
+
+    The request queue lives in this process's memory, so the server has to run here;
+    returns None (and sets start_error) when it cannot, and retries on the next call.
+    """
+    global _server, start_error
+    with _server_lock:
+        if _server is None:
+            if host not in _LOOPBACK_HOSTS and not BRIDGE_TOKEN:
+                start_error = f"拒绝在 {host} 上无口令对外监听，请设置 BRIDGE_TOKEN"
+                print(f"⚠️ Bridge server not started: {start_error}")
+                return None
+            try:
+                _server = ThreadingHTTPServer((host, port), BridgeHandler)
+            except OSError as e:
+                # 端口被占用时别的进程读不到本进程的队列，不能假装正常
+                start_error = f"{host}:{port} 启动失败: {e}"
+                print(f"⚠️ Bridge server not started: {start_error}")
+                return None
+            start_error = None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="bridge-server", daemon=True).start()
+        return _server
@@ -0,0 +1,121 @@
+import time
+import uuid
+import threading
+import collections
+
+# 车队模式的待处理请求队列 (所有用户共用，按入队时间先进先出)
+# 队列在 Streamlit 进程内存中，bridge_server 必须在同一进程里启动 (main.py 负责)，不能单独运行
+REQUEST_TTL = 90 # 排队超过 90 秒还没有机器人来取的请求不再派发
+# 机器人取走后多久未回传视为失败：car_bot 的 GEN_MAX_TIMEOUT (120 秒) 加上输入和回传的时间。
+# 租约比 REQUEST_TTL 长，过期的请求就算重新排队也早已超时，所以不再重派，只等可能迟到的回复
+LEASE_SECONDS = 150
+# 网页端最多等这么久：排队到快超时才被取走，再用满整个租约
+REPLY_TIMEOUT = REQUEST_TTL + LEASE_SECONDS
+LATE_REPLY_SECONDS = 600 # 过期或被丢弃的请求保留多久，期间迟到的回复仍然照收
+
+class PendingQueue:
+    def __init__(self, ttl=REQUEST_TTL, lease_seconds=LEASE_SECONDS):
+        self.ttl = ttl
+        self.lease_seconds = lease_seconds
+        self._cond = threading.Condition()
+        self._waiting = collections.deque()
+        self._inflight = {} # id -> (request, lease deadline)
+        self._abandoned = {} # id -> request，排队或租约超时、但可能还会收到回复的请求
+        self._counters = collections.Counter()
+
+    def enqueue(self, user, content, msg_id=None, turn_id=None):
+        """Queues a question and returns its request id"""
+        request = {
+            "id": uuid.uuid4().hex,
+            "user": user,
+            "content": content,
+            "msg_id": msg_id,
+            "turn": turn_id,
+            "enqueued_at": time.time(),
+        }
+        with self._cond:
+            self._waiting.append(request)
+            self._counters["enqueued"] += 1
+            self._cond.notify()
+        return request["id"]
+
+    def _expire_leases(self, now):
+        expired = [req_id for req_id, (_, deadline) in self._inflight.items() if deadline <= now]
+        for req_id in expired:
+            request, _ = self._inflight.pop(req_id)
+            self._abandoned[req_id] = request
+            self._counters["lease_expired"] += 1
+
+    def _pop_live(self, now):
+        while self._waiting:
+            request = self._waiting.popleft()
+            if now - request["enqueued_at"] < self.ttl:
+                return request
+            self._counters["dropped_stale"] += 1
+            self._abandoned[request["id"]] = request
+        return None
+
+    def dequeue(self, timeout=0):
+        """Leases the oldest live request, waiting up to timeout seconds; returns None if there is none"""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.time()
+                self._expire_leases(now)
+                request = self._pop_live(now)
+                if request:
+                    request["leased_at"] = now
+                    self._inflight[request["id"]] = (request, now + self.lease_seconds)
+                    self._counters["dequeued"] += 1
+                    return request
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                # 过期租约也要及时清出 inflight，因此最多等 1 秒再检查
+                self._cond.wait(min(remaining, 1.0))
+
+    def complete(self, req_id):
+        """Removes a request and returns it, or None if it is unknown or already answered.
+
+        A reply that arrives after the request's lease expired, or after it was dropped
+        as stale, is still returned (counted as completed_late); the caller decides
+        whether the question it answers is still open.
+        """
+        with self._cond:
+            now = time.time()
+            for stale_id, stale in list(self._abandoned.items()):
+                if now - stale["enqueued_at"] > LATE_REPLY_SECONDS:
+                    del self._abandoned[stale_id]
+            entry = self._inflight.pop(req_id, None)
+            request = entry[0] if entry else self._abandoned.pop(req_id, None)
+            if request is None:
+                return None
+            if entry is None:
+                self._counters["completed_late"] += 1
+            self._counters["completed"] += 1
+            return request
+
+    def stats(self):
+        with self._cond:
+            now = time.time()
+            oldest = self._waiting[0]["enqueued_at"] if self._waiting else None
+            return {
+                "depth": len(self._waiting),
+                "inflight": len(self._inflight),
+                "oldest_wait": round(now - oldest, 3) if oldest else 0,
+                **self._counters,
+            }
+
+_queue = PendingQueue()
+
+def enqueue(user, content, msg_id=None, turn_id=None):
+    return _queue.enqueue(user, content, msg_id, turn_id)
+
+def dequeue(timeout=0):
+    return _queue.dequeue(timeout)
+
+def complete(req_id):
+    return _queue.complete(req_id)
+
+def stats():
+    return _queue.stats()
@@ -4,6 +4,29 @@ import re
 import asyncio
 import edge_tts
 import os
+import uuid
+import hashlib
+import base64
+import threading
+import time
+from collections import deque
+import workers
+
+TTS_VOICE = "zh-CN-YunxiNeural"
+# 语音缓存：按 (文本, 音色) 的哈希存放，超出容量按最近使用时间淘汰
+TTS_CACHE_FOLDER = os.path.join("data", "tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+_tts_cache_lock = threading.Lock()
+# 同时合成的句子数上限：每句一条 edge_tts 连接，长回复不能一下子开几十条
+TTS_CONCURRENCY = 2
+_tts_slots = asyncio.Semaphore(TTS_CONCURRENCY)
+_tts_cache_bytes = None # 首次写入时统计
+
+# 流式朗读：遇到句末标点就切句；没有句末标点但已经很长时，退而在逗号处切
+SENTENCE_END = re.compile(r'[。！？!?；;\n]+')
+CLAUSE_END = re.compile(r'[，,、：:]')
+MAX_CLAUSE_CHARS = 40
 
 def render_sound_check():
     sound_check_html = """
@@ -42,17 +65,172 @@ def clean_markdown(text):
     text = re.sub(r'`(.*?)`', r'\1', text)
     return text
 
-async def generate_audio(text, output_file):
-    voice = "zh-CN-YunxiNeural"
-    communicate = edge_tts.Communicate(text, voice)
-    await communicate.save(output_file)
+def _tts_cache_path(text, voice):
+    key = hashlib.sha256(f"{voice}\n{text}".encode("utf-8")).hexdigest()
+    return os.path.join(TTS_CACHE_FOLDER, f"{key}.mp3")
+
+def _evict_tts_cache(added_bytes):
+    """Tracks cache size and deletes least recently used entries once over TTS_CACHE_MAX_BYTES"""
+    global _tts_cache_bytes
+    with _tts_cache_lock:
+        if _tts_cache_bytes is None:
+            _tts_cache_bytes = sum(e.stat().st_size for e in os.scandir(TTS_CACHE_FOLDER) if e.name.endswith(".mp3"))
+        else:
+            _tts_cache_bytes += added_bytes
+        if _tts_cache_bytes <= TTS_CACHE_MAX_BYTES:
+            return
+        # 命中时会刷新 mtime，所以 mtime 最旧的就是最久未使用的
+        entries = sorted((e for e in os.scandir(TTS_CACHE_FOLDER) if e.name.endswith(".mp3")), key=lambda e: e.stat().st_mtime)
+        _tts_cache_bytes = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if _tts_cache_bytes <= TTS_CACHE_MAX_BYTES * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                _tts_cache_bytes -= size
+            except FileNotFoundError:
+                pass
+
+async def _stream_audio(text, voice):
+    """Collects edge_tts output in memory, so no file I/O happens on the event loop"""
+    chunks = []
+    async for chunk in edge_tts.Communicate(text, voice).stream():
+        if chunk["type"] == "audio":
+            chunks.append(chunk["data"])
+    return b"".join(chunks)
+
+def _read_cached(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        os.utime(path)
+        return data
+    except FileNotFoundError:
+        return None
+
+def _store_cached(path, data):
+    os.makedirs(TTS_CACHE_FOLDER, exist_ok=True)
+    # 每次合成写入独立临时文件，并发会话互不覆盖
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _evict_tts_cache(len(data))
+
+async def synthesize_async(text, voice=TTS_VOICE):
+    """Returns MP3 bytes for text, running edge_tts only on a cache miss"""
+    path = _tts_cache_path(text, voice)
+    # 读写缓存和淘汰扫描都是阻塞 I/O，放到线程里，别卡住共享事件循环上的其他协程
+    data = await asyncio.to_thread(_read_cached, path)
+    if data is not None:
+        return data
+    async with _tts_slots:
+        data = await _stream_audio(text, voice)
+    await asyncio.to_thread(_store_cached, path, data)
+    return data
+
+def synthesize(text, voice=TTS_VOICE):
+    """Blocking wrapper around synthesize_async, run on the shared event loop"""
+    return workers.run_async(synthesize_async(text, voice)).result()
 
 def play_audio(text):
     clean_text = clean_markdown(text)
-    # Use a unique file name or overwrite
-    output_file = "reply.mp3"
     try:
-        asyncio.run(generate_audio(clean_text, output_file))
-        st.audio(output_file, format='audio/mp3', start_time=0, autoplay=True)
+        audio_bytes = synthesize(clean_text)
+        st.audio(audio_bytes, format='audio/mp3', start_time=0, autoplay=True)
     except Exception as e:
         st.warning(f"语音生成失败: {e}")
+
+def split_sentences(text):
+    """Returns (complete sentences, unfinished remainder) for a growing text buffer"""
+    sentences = []
+    start = 0
+    for m in SENTENCE_END.finditer(text):
+        sentences.append(text[start:m.end()])
+        start = m.end()
+    rest = text[start:]
+    if len(rest) > MAX_CLAUSE_CHARS:
+        cut = None
+        for m in CLAUSE_END.finditer(rest):
+            cut = m.end()
+        if cut:
+            sentences.append(rest[:cut])
+            rest = rest[cut:]
+    return sentences, rest
+
+# 在父页面里维护一个播放队列，各句音频依次播放，互不打断
+_AUDIO_QUEUE_HTML = """
+<script>
+(function() {
+    var w = window.parent;
+    if (!w.__laojiaPlayNext) {
+        w.__laojiaAudioQueue = [];
+        // 在父页面的上下文里定义，组件 iframe 被销毁后队列依然能继续播放
+        w.__laojiaPlayNext = new w.Function(
+            "var src = window.__laojiaAudioQueue.shift();" +
+            "if (!src) { window.__laojiaAudioPlaying = false; return; }" +
+            "window.__laojiaAudioPlaying = true;" +
+            "var audio = new Audio(src);" +
+            "audio.onended = audio.onerror = function() { window.__laojiaPlayNext(); };" +
+            "audio.play().catch(function() { window.__laojiaPlayNext(); });"
+        );
+    }
+    w.__laojiaAudioQueue.push("data:audio/mp3;base64,%s");
+    if (!w.__laojiaAudioPlaying) w.__laojiaPlayNext();
+})();
+</script>
+"""
+
+def queue_audio(audio_bytes):
+    """Appends an MP3 clip to the browser-side playback queue"""
+    components.html(_AUDIO_QUEUE_HTML % base64.b64encode(audio_bytes).decode("ascii"), height=0)
+
+class SpeechPipeline:
+    """Speaks a streamed reply sentence by sentence while it is still being generated.
+
+    feed() is called with each stream chunk; finished sentences are synthesized
+    concurrently on the shared event loop (see workers.py) and queued for playback in order as soon as they are ready.
+    Must be driven from the Streamlit script thread, since playback renders elements.
+    """
+    def __init__(self, voice=TTS_VOICE, turn=None):
+        self.voice = voice
+        self.turn = turn # tracing.Turn，用来记录首句出声耗时
+        self._started = time.perf_counter()
+        self._first_played = False
+        self._buffer = ""
+        self._pending = deque() # 按句子顺序排列的合成任务
+
+    def _submit(self, sentence):
+        text = clean_markdown(sentence).strip()
+        if text:
+            self._pending.append(workers.run_async(synthesize_async(text, self.voice)))
+
+    def _play(self, future):
+        try:
+            queue_audio(future.result())
+            if self.turn and not self._first_played:
+                self.turn.since("tts_first_audio", self._started)
+            self._first_played = True
+        except Exception as e:
+            st.warning(f"语音生成失败: {e}")
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        sentences, self._buffer = split_sentences(self._buffer)
+        for sentence in sentences:
+            self._submit(sentence)
+        # 只播放已经按顺序合成好的句子，不阻塞生成
+        while self._pending and self._pending[0].done():
+            self._play(self._pending.popleft())
+
+    def finish(self):
+        """Flushes the trailing text and waits for all remaining clips to be queued"""
+        self._submit(self._buffer)
+        self._buffer = ""
+        while self._pending:
+            self._play(self._pending.popleft())
@@ -0,0 +1,96 @@
+import os
+import re
+import storage
+
+# 官方 API 模式的上下文窗口：最近的对话原样保留，更早的对话折叠进持久化的滚动摘要
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "8000"))
+# 超出预算时一次折叠到预算的这个比例，避免之后每轮都要调用一次摘要
+FOLD_TARGET_RATIO = 0.5
+IMAGE_TOKENS = 258 # Gemini 对单张图片的计费近似值
+KEEP_IMAGES_LAST_N = 4 # 只有最近几条消息里的图片才发给模型
+SUMMARY_MAX_CHARS = 2000
+READ_PAGE = 32
+
+_CJK = re.compile(r'[\u3000-\u9fff\uff00-\uffef]')
+
+def estimate_tokens(msg, with_images=True):
+    """Rough token estimate: one per CJK character, one per 4 other characters, a flat cost per image"""
+    tokens = 4
+    for part in msg["parts"]:
+        if isinstance(part, dict) and part.get("type") == "image":
+            tokens += IMAGE_TOKENS if with_images else 2
+            continue
+        text = part.get("text", "") if isinstance(part, dict) else str(part)
+        cjk = len(_CJK.findall(text))
+        tokens += cjk + (len(text) - cjk) // 4
+    return tokens
+
+def _drop_images(msg):
+    parts = []
+    for part in msg["parts"]:
+        if isinstance(part, dict) and part.get("type") == "image":
+            parts.append({"type": "text", "text": "[图片]"})
+        else:
+            parts.append(part)
+    return {"role": msg["role"], "parts": parts}
+
+def _fallback_summary(previous, messages):
+    # 摘要模型不可用时的兜底：直接拼接，只保留最新的部分
+    lines = [previous] if previous else []
+    for msg in messages:
+        speaker = "主人" if msg["role"] == "user" else "老贾"
+        lines.append(f"{speaker}: {storage.message_text(msg, '[图片]')[:200]}")
+    return "\n".join(lines)[-SUMMARY_MAX_CHARS:]
+
+def make_gemini_summarizer(model):
+    """Builds a summarize(previous, messages) callback on top of a configured GenerativeModel"""
+    def summarize(previous, messages):
+        transcript = "\n".join(
+            f"{'主人' if m['role'] == 'user' else '老贾'}: {storage.message_text(m, '[图片]')}" for m in messages)
+        prompt = (
+            f"下面是已有的对话摘要和之后新增的对话。请把新增对话中值得长期记住的信息"
+            f"(主人的情况、偏好、约定、未完成的事)合并进摘要，输出不超过 {SUMMARY_MAX_CHARS // 4} 字的中文摘要，只输出摘要本身。\n\n"
+            f"【已有摘要】\n{previous or '(无)'}\n\n【新增对话】\n{transcript}")
+        return model.generate_content(prompt).text.strip()[:SUMMARY_MAX_CHARS]
+    return summarize
+
+def _window_start(username, floor, upto, budget):
+    """Walks back from upto and returns (start, tokens) of the longest suffix that fits in budget"""
+    start, used = upto, 0
+    while start > floor:
+        page = storage.read_messages(username, max(floor, start - READ_PAGE), start)
+        for msg in reversed(page):
+            keep_images = upto - start < KEEP_IMAGES_LAST_N
+            cost = estimate_tokens(msg, with_images=keep_images)
+            if used + cost > budget:
+                return start, used
+            used += cost
+            start -= 1
+    return start, used
+
+def build_context(username, upto, summarize=None, budget=CONTEXT_TOKEN_BUDGET):
+    """Returns (summary_text, messages) covering messages [0, upto) within the token budget.
+
+    Recent messages are returned verbatim (images only for the last few); anything older
+    than the window is folded into the running summary stored next to the chat journal.
+    """
+    summary = storage.load_summary(username)
+    floor = min(summary.get("upto", 0), upto)
+    start, _ = _window_start(username, floor, upto, budget)
+    
+    if start > floor:
+        # 窗口放不下了：折叠到预算的一半，留出余量给之后几轮
+        start, _ = _window_start(username, floor, upto, int(budget * FOLD_TARGET_RATIO))
+        folded = storage.read_messages(username, floor, start)
+        text = summary.get("text", "")
+        try:
+            text = summarize(text, folded) if summarize else _fallback_summary(text, folded)
+        except Exception:
+            text = _fallback_summary(text, folded)
+        summary = {"upto": start, "text": text}
+        storage.save_summary(username, summary)
+    
+    messages = storage.read_messages(username, start, upto)
+    keep_from = len(messages) - KEEP_IMAGES_LAST_N
+    messages = [msg if i >= keep_from else _drop_images(msg) for i, msg in enumerate(messages)]
+    return summary.get("text", ""), messages
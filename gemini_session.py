@@ -0,0 +1,110 @@
+import os
+import google.generativeai as genai
+import storage
+import context
+import search_index
+
+MODEL_NAME = "gemini-3-flash-preview"
+
+def session_key(api_key, profile):
+    """Anything that changes the model or system prompt must invalidate the cached session"""
+    return (api_key, profile.get("style"), profile.get("nickname"))
+
+def to_gemini_parts(username, msg):
+    from PIL import Image
+    parts = []
+    for p in msg["parts"]:
+        if isinstance(p, dict):
+            if p["type"] == "text": parts.append(p["text"])
+            elif p["type"] == "image":
+                img_path = storage.image_file(username, p["path"])
+                if os.path.exists(img_path):
+                    try: parts.append(Image.open(img_path))
+                    except: pass
+        else:
+            parts.append(str(p))
+    return parts
+
+class GeminiSession:
+    """A live ChatSession for one user, kept in st.session_state across reruns.
+
+    Each turn only appends to the existing chat; the history is rebuilt from the
+    context window when the journal moved on without us (car mode, another device),
+    when the token budget is exceeded, or after a failed turn.
+    """
+    def __init__(self, username, api_key, profile):
+        self.username = username
+        self.api_key = api_key
+        self.profile = profile
+        self.key = session_key(api_key, profile)
+        self.chat = None
+        self.upto = None # 已进入 chat 历史的消息数 (日志中的位置)
+        self.window_start = 0 # chat 历史从日志的哪条消息开始，更早的只能靠摘要和检索
+        self._has_recall = False # 本轮附带了检索片段，回复写入后要从 chat 历史里去掉
+        self.tokens = 0
+
+    def _rebuild(self, upto):
+        genai.configure(api_key=self.api_key)
+        
+        # System Prompt
+        sys_prompt = f"你是一个名为'老贾'的AI助手。你的主人是 {self.profile.get('nickname', self.username)}。你的性格是 {self.profile.get('style', '温馨')}。"
+        
+        # 上下文窗口：最近的对话原样发送，更早的折叠进滚动摘要
+        summarizer = context.make_gemini_summarizer(genai.GenerativeModel(MODEL_NAME))
+        summary, context_msgs = context.build_context(self.username, upto, summarizer)
+        if summary:
+            sys_prompt += f"\n以下是你和主人更早之前对话的摘要，供你参考：\n{summary}"
+        
+        model = genai.GenerativeModel(MODEL_NAME, system_instruction=sys_prompt)
+        history_for_gemini = [
+            {"role": "user" if msg["role"] == "user" else "model", "parts": to_gemini_parts(self.username, msg)}
+            for msg in context_msgs
+        ]
+        self.chat = model.start_chat(history=history_for_gemini)
+        self.upto = upto
+        self.window_start = upto - len(context_msgs)
+        self.tokens = sum(context.estimate_tokens(msg) for msg in context_msgs)
+
+    def send(self, msg_id, msg):
+        """Streams the model's answer to msg, which is stored in the journal at msg_id"""
+        if self.chat is None or self.upto != msg_id or self.tokens > context.CONTEXT_TOKEN_BUDGET:
+            self._rebuild(msg_id)
+        self.upto = None # 回复写入之前，这个会话处于未完成状态
+        self.tokens += context.estimate_tokens(msg)
+        parts = to_gemini_parts(self.username, msg)
+        # 窗口之外的旧对话里和这句话相关的几条，附在本轮消息前面 (只用于这一轮)
+        self._has_recall = False
+        try:
+            recalled = search_index.recall(self.username, storage.message_text(msg), before=self.window_start)
+        except Exception as e:
+            # 检索只是锦上添花，出错就不带往事，这一轮照常回答
+            print(f"⚠️ Recall failed for {self.username}: {e}")
+            recalled = []
+        if recalled:
+            note = search_index.format_recall(recalled)
+            parts.insert(0, note)
+            self._has_recall = True
+        return self.chat.send_message(parts, stream=True)
+
+    def _strip_recall(self):
+        """Drops this turn's recall note from the chat history so notes don't pile up across turns"""
+        history = self.chat.history
+        user_turn = history[-2]
+        history[-2] = {"role": "user", "parts": list(user_turn.parts)[1:]}
+        self.chat.history = history
+
+    def commit(self, reply_id, reply_msg):
+        """Records that the streamed reply was stored at reply_id, so the next turn can reuse the chat"""
+        if self._has_recall:
+            try:
+                self._strip_recall()
+            except Exception:
+                # 历史结构对不上就下一轮重建，宁可慢一点也不带着旧片段
+                self.reset()
+                return
+            self._has_recall = False
+        self.upto = reply_id + 1
+        self.tokens += context.estimate_tokens(reply_msg)
+
+    def reset(self):
+        self.chat = None
@@ -1,223 +1,794 @@
+import os
 import sys
 import time
 import json
+import queue
+import threading
+import requests
 from DrissionPage import ChromiumPage, ChromiumOptions
 
+# 与服务端共用仓库根目录的 tracing.py，按 turn_id 和网页端的耗时记录对齐
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import tracing
+
 # ================= 配置区 =================
 # 1. 车队配置
 TARGET_URL = 'https://claudechn.com/pastel/#/gemini-carlist'
+# 浏览器资料目录 (保存登录 cookie) 和上次成功进入的聊天页，重启时直接回到聊天页
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROFILE_DIR = os.environ.get("CAR_PROFILE_DIR", os.path.join(BOT_DIR, "chrome_profile"))
+STATE_FILE = os.environ.get("CAR_STATE_FILE", os.path.join(BOT_DIR, "bot_state.json"))
+REATTACH_TIMEOUT = 20 # 热启动时等待聊天输入框的秒数，超时走完整选车流程
 
 # 2. 老贾配置
-ZEABUR_URL = "https://laojia.zeabur.app"
-LAOJIA_USER = "breezecity" 
+# 信箱 JSON 接口 (bridge_server.py) 的地址，必须设置，例如 http://bridge.example.com:8502
+# 它是独立端口上的纯 HTTP 服务，不能用 Streamlit 页面的 https 域名加端口号访问，部署方式见 zeabur.toml
+BRIDGE_URL = os.environ.get("LAOJIA_BRIDGE_URL", "")
+BRIDGE_TOKEN = os.environ.get("LAOJIA_BRIDGE_TOKEN", "") # 与服务端 BRIDGE_TOKEN 相同
+POLL_TIMEOUT = 25 # 长轮询等待秒数 (服务端上限 30)
+HTTP_TIMEOUT = 15 # 回传等普通请求的超时秒数
+
+# 3. 生成完成检测
+# 单次生成最长等待秒数；调大时服务端 car_queue.LEASE_SECONDS 也要跟着调大
+GEN_MAX_TIMEOUT = int(os.environ.get("GEN_MAX_TIMEOUT", "120"))
+GEN_STABLE_SECONDS = 2.0 # 回复文本保持不变多久视为生成完毕
+GEN_CHECK_INTERVAL = 0.5
+STOP_BTN_SELECTORS = ('xpath://button[contains(., "停止")]', '@title=停止', '@aria-label=Stop')
+
+# 4. 车位池：同时占用 N 辆最空闲的 Pro 车，每辆车一个聊天标签页
+POOL_SIZE = int(os.environ.get("CAR_POOL_SIZE", "2"))
+MAX_TAB_FAILURES = 3 # 单个标签页连续失败多少次视为不健康并换车
+NEW_CHAT_TIMEOUT = 10 # 换用户时等待新对话就绪的秒数
+
+# 5. 资源与内存控制 (J1800 内存小，浏览器要连续跑好几天)
+# 聊天页只需要文字和脚本：图片、字体、音视频在网络层直接拦截
+BLOCKED_URL_PATTERNS = ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.svg', '*.ico',
+                        '*.woff', '*.woff2', '*.ttf', '*.otf', '*.mp3', '*.mp4', '*.webm']
+TAB_MAX_DOM_NODES = int(os.environ.get("CAR_TAB_MAX_DOM_NODES", "20000")) # 超过就换新标签页
+TAB_MAX_JS_HEAP_MB = int(os.environ.get("CAR_TAB_MAX_JS_HEAP_MB", "300"))
+TAB_MAX_TURNS = int(os.environ.get("CAR_TAB_MAX_TURNS", "50")) # 指标正常也定期换新
+BROWSER_MAX_RSS_MB = int(os.environ.get("CAR_BROWSER_MAX_RSS_MB", "1500")) # 整个浏览器进程树的上限
+WATCHDOG_INTERVAL = 60
+
+# 6. 选车评分：按实际回复耗时和失败率 (指数滑动平均) 加上车上人数打分，分数越低越好
+STATS_ALPHA = 0.3 # 滑动平均权重，越大越看重最近几次
+LATENCY_PRIOR = 30.0 # 没有观测数据的车按这个回复秒数估计
+FAILURE_PENALTY = 3.0 # 失败率 100% 时预计耗时放大 (1 + 3) 倍
+COUNT_WEIGHT = 0.5 # 车上每多一个人，分数加多少秒
+DEGRADED_LATENCY = float(os.environ.get("CAR_DEGRADED_LATENCY", "60")) # 平均回复超过这个秒数视为变慢
+DEGRADED_FAILURE_RATE = 0.4
+MIN_SAMPLES = 3 # 至少观测几次才判断变慢
+MIGRATE_MARGIN = 0.7 # 候选车分数要低于当前车的 70% 才值得迁移
+MIGRATE_COOLDOWN = 300 # 同一个标签页两次迁移检查的最短间隔秒数
+STATS_TTL = 3600 # 超过这么久没有新观测的数据作废，之前慢过的车过段时间还有机会
+CAR_REFRESH_INTERVAL = int(os.environ.get("CAR_REFRESH_INTERVAL", "600")) # 空闲时多久刷新一次车况
 # ==========================================
 
-def run_laojia_bridge():
+class Mailbox:
+    """老贾信箱的 HTTP 客户端：保持长连接，不再占用浏览器标签页。
+    requests.Session 不保证线程安全，所以每个线程各用一个 (长轮询和各工作线程的回传互不阻塞)"""
+    def __init__(self, base_url=BRIDGE_URL, token=BRIDGE_TOKEN):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self._local = threading.local()
+
+    def _session(self):
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            if self.token:
+                session.headers["X-Bridge-Token"] = self.token
+        return session
+
+    def health(self):
+        resp = self._session().get(f"{self.base_url}/health", timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+    def next(self, timeout=POLL_TIMEOUT):
+        """长轮询全体用户的待处理队列：服务端有新请求或超时才返回"""
+        resp = self._session().get(f"{self.base_url}/next", params={"timeout": timeout}, timeout=timeout + HTTP_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+    def reply(self, req_id, msg, spans=None):
+        payload = {"id": req_id, "msg": msg}
+        if spans:
+            payload["spans"] = spans # 本地耗时记录，服务端写进同一个 turn
+        resp = self._session().post(f"{self.base_url}/reply", json=payload, timeout=HTTP_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+def block_resources(tab):
+    """在网络层拦截不需要的资源类型 (对该标签页之后的所有请求生效)"""
+    try:
+        tab.run_cdp('Network.enable')
+        tab.run_cdp('Network.setBlockedURLs', urls=BLOCKED_URL_PATTERNS)
+    except Exception as e:
+        print(f"⚠️ 资源拦截设置失败: {e}")
+
+def tab_stats(tab):
+    """返回 (DOM 节点数, JS 堆占用 MB)"""
+    nodes, heap = tab.run_js(
+        'return [document.getElementsByTagName("*").length, performance.memory ? performance.memory.usedJSHeapSize : 0];')
+    return nodes, heap / 1024 / 1024
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def process_tree_rss(root_pid=None):
+    """统计 root_pid 所有子孙进程的 RSS 字节数 (Chromium 由本进程启动，各渲染进程都在这棵树里)"""
+    root_pid = root_pid or os.getpid()
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # 进程名可能带空格和括号，从最后一个 ')' 之后解析：state ppid ...
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    stack = list(children.get(root_pid, []))
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * _PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+class BrowserWatchdog:
+    """后台线程：定期汇报浏览器内存，超过 BROWSER_MAX_RSS_MB 时通知主循环重启 Chromium"""
+    def __init__(self, limit_mb=BROWSER_MAX_RSS_MB, interval=WATCHDOG_INTERVAL):
+        self.limit_mb = limit_mb
+        self.interval = interval
+        self.restart_requested = threading.Event()
+        self._stopped = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self._run, name="watchdog", daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            rss_mb = process_tree_rss() / 1024 / 1024
+            print(f"\n🩺 浏览器内存: {rss_mb:.0f} MB (上限 {self.limit_mb} MB)")
+            if rss_mb > self.limit_mb and not self.restart_requested.is_set():
+                print("♻️ 浏览器内存超限，处理完手头的请求后重启 Chromium")
+                self.restart_requested.set()
+
+def get_replies(tab):
+    return tab.eles('.content') or tab.eles('.message-content')
+
+def is_generating(tab):
+    for sel in STOP_BTN_SELECTORS:
+        if tab.ele(sel, timeout=0):
+            return True
+    return False
+
+def wait_for_answer(tab, prev_count, max_timeout=GEN_MAX_TIMEOUT, turn=None):
+    """等待新回复出现并生成完毕：停止按钮消失且最后一条回复文本稳定 GEN_STABLE_SECONDS 秒。
+    超时返回当前已有的文本 (可能不完整)，没有新回复则返回 None"""
+    deadline = time.time() + max_timeout
+    last_text = None
+    stable_since = None
+    scrape_seconds = 0.0 # 读取 DOM 累计耗时
+    try:
+        while time.time() < deadline:
+            t0 = time.perf_counter()
+            replies = get_replies(tab)
+            text = replies[-1].text if len(replies) > prev_count else None
+            scrape_seconds += time.perf_counter() - t0
+            if text is not None:
+                if text != last_text:
+                    last_text, stable_since = text, time.time()
+                elif text and not is_generating(tab) and time.time() - stable_since >= GEN_STABLE_SECONDS:
+                    return text
+            time.sleep(GEN_CHECK_INTERVAL)
+        if last_text:
+            print(f"⚠️ 生成超过 {max_timeout} 秒，回传已生成部分")
+        return last_text
+    finally:
+        if turn:
+            turn.record("scrape", scrape_seconds * 1000)
+
+class CarStats:
+    """单辆车的观测表现：成功回复耗时和失败率的指数滑动平均"""
+    def __init__(self, latency=None, failure_rate=0.0, samples=0, updated_at=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.samples = samples
+        self.updated_at = updated_at or time.time()
+
+    @property
+    def stale(self):
+        return time.time() - self.updated_at > STATS_TTL
+
+    def record(self, seconds, ok):
+        if self.stale:
+            self.__init__()
+        self.updated_at = time.time()
+        self.samples += 1
+        self.failure_rate += STATS_ALPHA * ((0.0 if ok else 1.0) - self.failure_rate)
+        if ok:
+            self.latency = seconds if self.latency is None else self.latency + STATS_ALPHA * (seconds - self.latency)
+
+    @property
+    def degraded(self):
+        if self.samples < MIN_SAMPLES or self.stale:
+            return False
+        return (self.latency or 0) > DEGRADED_LATENCY or self.failure_rate > DEGRADED_FAILURE_RATE
+
+    def to_dict(self):
+        return {"latency": self.latency, "failure_rate": self.failure_rate, "samples": self.samples, "updated_at": self.updated_at}
+
+    def __str__(self):
+        latency = f"{self.latency:.1f}s" if self.latency is not None else "?"
+        return f"平均 {latency}, 失败率 {self.failure_rate:.0%}"
+
+class CarTab:
+    """车位池中的一个聊天标签页及其健康状况"""
+    def __init__(self, tab, car_id, model=None):
+        self.tab = tab
+        self.car_id = car_id
+        self.model = model # 选中的模型名称，热启动时优先选回它
+        self.url = tab.url
+        self.migrate_checked_at = time.time()
+        self.failures = 0 # 连续失败次数
+        self.served = 0
+        self.last_error = None
+        # 网页聊天会把之前的每一轮都当作上下文，不同用户不能共用同一个对话
+        self.user = None # 当前对话里是谁的问题
+        self.used = False # 对话里是否已经有内容 (热启动回到的旧对话也算)
+
+    @property
+    def healthy(self):
+        return self.failures < MAX_TAB_FAILURES
+
+    def record_success(self):
+        self.failures = 0
+        self.served += 1
+
+    def record_failure(self, e):
+        self.failures += 1
+        self.last_error = str(e)
+
+    def needs_new_chat(self, user):
+        return self.used and self.user != user
+
+    def start_new_chat(self, browser):
+        """换用户前清空上下文：先点“新建对话”，不行就在同一辆车上重新开一个聊天页"""
+        if new_conversation(self.tab):
+            self.url = self.tab.url
+            return
+        fresh = open_car_chat(browser, self.car_id)
+        if fresh is None or get_replies(fresh.tab):
+            if fresh:
+                try: fresh.tab.close()
+                except: pass
+            # 宁可这一问报错，也不能带着别人的对话作答
+            raise RuntimeError("无法开启新对话")
+        try: self.tab.close()
+        except: pass
+        self.tab, self.url, self.model = fresh.tab, fresh.url, fresh.model
+        self.used = False
+
+    def recycle_reason(self):
+        """标签页该换新时返回原因，否则返回 None"""
+        if self.served >= TAB_MAX_TURNS:
+            return f"已处理 {self.served} 轮"
+        try:
+            nodes, heap_mb = tab_stats(self.tab)
+        except Exception as e:
+            return f"读取页面状态失败: {e}"
+        if nodes > TAB_MAX_DOM_NODES:
+            return f"DOM 节点 {nodes}"
+        if heap_mb > TAB_MAX_JS_HEAP_MB:
+            return f"JS 堆 {heap_mb:.0f} MB"
+        return None
+
+    def __str__(self):
+        return f"车位 {self.car_id or '?'} (已处理 {self.served}, 连续失败 {self.failures})"
+
+def new_conversation(tab):
+    """在当前聊天页点“新建对话”，等到出现没有任何回复的输入框；做不到返回 False"""
+    btn = tab.ele('text:新建对话', timeout=3) or tab.ele('text:新对话', timeout=1)
+    if not btn:
+        return False
+    btn.click()
+    deadline = time.time() + NEW_CHAT_TIMEOUT
+    while time.time() < deadline:
+        if tab.ele('tag:textarea', timeout=1) and not get_replies(tab):
+            return True
+        time.sleep(0.5)
+    return False
+
+def dismiss_popups(tab):
+    # 弹窗处理
+    if tab.ele('text:今日不再弹出', timeout=5):
+        tab.ele('text:今日不再弹出').click()
+        if tab.ele('text=确定'): tab.ele('text=确定').click()
+
+def fetch_pro_cars(tab):
+    """打开车库并抓包车况，返回可用 Pro 车位 (按 count 从少到多)，抓包失败返回 []"""
+    block_resources(tab)
+    tab.listen.start('geminiCarpage')
+    print("🌍 正在访问车库...")
+    tab.get(TARGET_URL)
+    time.sleep(3)
+    dismiss_popups(tab)
+
+    print("🔍 正在分析车况...")
+    res = tab.listen.wait(timeout=15)
+    tab.listen.stop()
+    if not res:
+        print("⚠️ 抓包超时")
+        return []
+    car_list = res.response.body['data']['list']
+    pro_cars = [c for c in car_list if c['isPro'] == True and c['status'] == 1]
+    pro_cars.sort(key=lambda x: x['count'])
+    return pro_cars
+
+def select_model(tab, preferred=None):
+    """切换到 Gemini 3 Pro (或上次选中的 preferred)，返回选中的模型名称，没切换返回 None"""
+    print("🎯 等待 Gemini 3 Pro 模型就绪...")
+    # Wait for model selector
+    model_btn = tab.ele('text=Gemini', timeout=15)
+    if model_btn:
+        model_btn.click()
+        time.sleep(1)
+        # Try multiple selectors for the model
+        target_model = ((preferred and tab.ele(f'text={preferred}', timeout=3)) or
+                       tab.ele('text:3 Pro', timeout=5) or 
+                       tab.ele('text:Gemini 3 Pro', timeout=5) or
+                       tab.ele('text:1.5 Pro', timeout=5)) # Fallback
+        if target_model: 
+            model = target_model.text
+            target_model.click()
+            print("✅ 模型切换成功")
+            return model
+        else:
+            print("⚠️ 未找到目标模型，保持默认")
+    else:
+        print("⚠️ 未找到模型切换按钮 (可能是移动端视图或已隐藏)")
+    return None
+
+def open_car_chat(browser, car_id, tab=None):
+    """在车库页点选车位并进入聊天室，返回 CarTab；进不去返回 None"""
+    if tab is None:
+        tab = browser.new_tab()
+        block_resources(tab)
+        tab.get(TARGET_URL)
+        time.sleep(3)
+        dismiss_popups(tab)
+    
+    tabs_before = set(browser.tab_ids)
+    target_ele = tab.ele(f'text:{car_id}', timeout=10) if car_id else None
+    if target_ele:
+        print(f"🥇 选定车位: {car_id}")
+        target_ele.click()
+    else:
+        print("⚠️ 未找到目标车位，尝试盲点第一个车位...")
+        tab.ele('text:Gemini').click()
+        
+    print("🚀 正在前往聊天室...")
+    # J1800 might be slow, give it time to open tab/redirect
+    time.sleep(5)
+    
+    # IMPORTANT: Switch to the new tab in case one was opened
+    new_tabs = [t for t in browser.tab_ids if t not in tabs_before]
+    if new_tabs:
+        tab.close()
+        tab = browser.get_tab(new_tabs[0])
+        block_resources(tab)
+    print(f"📍 当前页面: {tab.title}")
+    
+    # URL 跳转检查 (防止 J1800 响应慢导致还在车库页)
+    print("🔗 检查 URL 跳转状态...")
+    url_ok = False
+    for _ in range(15): # 等待 15 秒
+        if "/#/chat/" in tab.url:
+            print(f"✅ URL 确认: {tab.url}")
+            url_ok = True
+            break
+        time.sleep(1)
+    
+    if not url_ok:
+         print(f"⚠️ 警告: 15秒后 URL 仍未包含 /chat/ (当前: {tab.url})")
+
+    # Wait for chat input to confirm we are in
+    # Increased timeout for J1800
+    if not tab.ele('tag:textarea', timeout=45):
+        print("⚠️ 警告: 45秒内未找到输入框，尝试刷新页面...")
+        tab.refresh()
+        time.sleep(5)
+        # Check again
+        if not tab.ele('tag:textarea', timeout=30):
+            print("❌ 严重错误: 无法加载聊天页面 (可能被重定向到了登录页)")
+            tab.close()
+            return None
+    print("✅ 成功抵达聊天页面")
+    
+    return CarTab(tab, car_id, select_model(tab))
+
+def reattach_chat(browser, saved, tab=None):
+    """热启动：直接打开上次的聊天页 (登录状态保存在 PROFILE_DIR)，不行返回 None"""
+    url = saved.get("url") or ""
+    if "/#/chat/" not in url:
+        return None
+    print(f"⚡ 尝试直接回到聊天页: {url}")
+    created = tab is None
+    if created:
+        tab = browser.new_tab()
+    block_resources(tab)
+    try:
+        tab.get(url)
+        # 会话失效时会被重定向回车库或登录页
+        if tab.ele('tag:textarea', timeout=REATTACH_TIMEOUT) and "/#/chat/" in tab.url:
+            print("✅ 热启动成功")
+            car_tab = CarTab(tab, saved.get("car_id"), select_model(tab, saved.get("model")))
+            car_tab.used = True # 旧对话里不知道是谁的内容，第一次使用前要换新对话
+            return car_tab
+    except Exception as e:
+        print(f"⚠️ 热启动失败: {e}")
+    print("⚠️ 聊天页已失效，改走完整选车流程")
+    if created:
+        # 自己开的标签页要关掉，否则每个失效的存档都会留下一个渲染进程
+        try: tab.close()
+        except: pass
+    return None
+
+def load_state():
+    try:
+        with open(STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(car_tabs, car_stats=None):
+    """记录当前各聊天页的地址、车位和模型，以及各车的观测表现 (先写临时文件再替换)"""
+    state = {
+        "cars": [{"car_id": c.car_id, "url": c.url, "model": c.model} for c in car_tabs],
+        "car_stats": {car_id: stats.to_dict() for car_id, stats in (car_stats or {}).items()},
+        "saved_at": time.time(),
+    }
+    tmp_path = f"{STATE_FILE}.{threading.get_ident()}.tmp" # 后台刷新线程也会保存
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, STATE_FILE)
+    except OSError as e:
+        print(f"⚠️ 保存状态失败: {e}")
+
+def ask(tab, question, turn):
+    """在聊天标签页提问并等待生成完毕，返回回复文本"""
+    with turn.span("input"):
+        input_box = tab.ele('@placeholder=输入消息') or tab.ele('tag:textarea')
+        if not input_box:
+            raise RuntimeError("未找到输入框 (可能车位已失效)")
+        prev_count = len(get_replies(tab))
+        input_box.input(question)
+        
+        send_btn = tab.ele('xpath://button[contains(., "发送")]') or tab.ele('@title=发送')
+        send_btn.click()
+    
+    with turn.span("generation_wait"):
+        ans = wait_for_answer(tab, prev_count, turn=turn)
+    if not ans:
+        raise RuntimeError("等待回复超时")
+    return ans
+
+class CarPool:
+    """N 个聊天标签页 + 空闲队列：新问题总是交给最先空闲下来的健康标签页。
+    同时记录每辆车的表现，换车、迁移都挑分数最好的备用车"""
+    def __init__(self, browser):
+        self.browser = browser
+        self.slots = []
+        self.idle = queue.Queue()
+        self.car_counts = {} # 最近一次抓到的车况: car_id -> count
+        self.refreshed_at = 0.0
+        self.refresh_lock = threading.Lock() # 同一时间只跑一个后台刷新
+        self.stats_lock = threading.Lock()
+        saved = load_state().get("car_stats", {})
+        self.stats = {car_id: CarStats(**s) for car_id, s in saved.items()}
+
+    def start(self, size):
+        # 先按上次保存的状态直接回到聊天页，不够的再走完整选车流程
+        spare_tab = self.browser.latest_tab # 第一辆车复用启动时的标签页
+        for saved in load_state().get("cars", [])[:size]:
+            car_tab = reattach_chat(self.browser, saved, spare_tab)
+            if car_tab:
+                spare_tab = None
+                self._add(car_tab)
+        if len(self.slots) < size:
+            tab = spare_tab or self.browser.new_tab()
+            self._update_cars(fetch_pro_cars(tab))
+            missing = size - len(self.slots)
+            car_ids = self.spare_cars()
+            for car_id in (car_ids[:missing] or ([None] if not self.slots else [])):
+                # 第一辆车复用车库页
+                car_tab = open_car_chat(self.browser, car_id, tab)
+                tab = None
+                if car_tab:
+                    self._add(car_tab)
+            if tab is not None and self.slots:
+                tab.close()
+        self.save()
+        print(f"🚗 车位池就绪: {len(self.slots)}/{size} 个聊天标签页")
+        return len(self.slots) > 0
+
+    def _add(self, car_tab):
+        self.slots.append(car_tab)
+        self.idle.put(car_tab)
+
+    def save(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        save_state(self.slots, stats)
+
+    def record(self, car_id, seconds, ok):
+        """工作线程调用：记录一次请求的耗时和成败"""
+        if car_id is None:
+            return
+        with self.stats_lock:
+            stats = self.stats.setdefault(car_id, CarStats())
+            stats.record(seconds, ok)
+
+    def score(self, car_id):
+        """越小越好：预计回复秒数 (按失败率加罚) + 车上人数的影响"""
+        with self.stats_lock:
+            stats = self.stats.get(car_id)
+        if stats is None or stats.stale:
+            stats = CarStats()
+        latency = stats.latency if stats.latency is not None else LATENCY_PRIOR
+        return latency * (1 + FAILURE_PENALTY * stats.failure_rate) + COUNT_WEIGHT * self.car_counts.get(car_id, 0)
+
+    def spare_cars(self):
+        """没在用的车位，按分数从好到差"""
+        in_use = {c.car_id for c in self.slots}
+        return sorted((car_id for car_id in self.car_counts if car_id not in in_use), key=self.score)
+
+    def _update_cars(self, cars):
+        if cars:
+            self.car_counts = {c['carID']: c['count'] for c in cars}
+        self.refreshed_at = time.time()
+
+    def refresh_cars(self):
+        """在临时标签页里重新抓一次车况 (人数会变，车也会上下线)"""
+        tab = self.browser.new_tab()
+        try:
+            self._update_cars(fetch_pro_cars(tab))
+        finally:
+            tab.close()
+        self.save()
+
+    def maybe_refresh(self):
+        """主循环空闲时调用：距上次抓车况超过 CAR_REFRESH_INTERVAL 就在后台线程里刷新，不耽误取件"""
+        if time.time() - self.refreshed_at < CAR_REFRESH_INTERVAL or not self.refresh_lock.acquire(blocking=False):
+            return
+        def run():
+            try:
+                self.refresh_cars()
+            except Exception as e:
+                print(f"\n⚠️ 刷新车况失败: {e}")
+                self.refreshed_at = time.time() # 失败也等下一个周期再试
+            finally:
+                self.refresh_lock.release()
+        threading.Thread(target=run, name="car-refresh", daemon=True).start()
+
+    def _open_best(self, threshold=None):
+        """按分数依次尝试备用车，返回新开的 CarTab；都不行 (或都不比 threshold 好) 返回 None"""
+        if not self.car_counts:
+            self.refresh_cars()
+        for car_id in self.spare_cars():
+            if threshold is not None and self.score(car_id) >= threshold:
+                break
+            fresh = open_car_chat(self.browser, car_id)
+            if fresh:
+                return fresh
+            self.record(car_id, 0, False) # 进不去的车降分，下次排到后面
+        return None
+
+    def replace(self, car_tab):
+        """关掉不健康的标签页，换一辆分数最好的备用车顶上"""
+        print(f"🩺 {car_tab} 不健康 ({car_tab.last_error})，正在换车...")
+        self.slots.remove(car_tab)
+        try: car_tab.tab.close()
+        except: pass
+        fresh = self._open_best()
+        if fresh:
+            self._add(fresh)
+        else:
+            print("⚠️ 没有可用的备用车位")
+        self.save()
+        return fresh is not None
+
+    def migrate(self, car_tab):
+        """当前车变慢或经常失败时，换到明显更好的车；没有更好的就继续用当前车"""
+        car_tab.migrate_checked_at = time.time()
+        current = self.score(car_tab.car_id)
+        fresh = self._open_best(threshold=current * MIGRATE_MARGIN)
+        if not fresh:
+            return car_tab
+        print(f"🔀 车位 {car_tab.car_id} 表现变差 ({self.stats[car_tab.car_id]})，迁移到 {fresh.car_id}")
+        try: car_tab.tab.close()
+        except: pass
+        self.slots[self.slots.index(car_tab)] = fresh
+        self.save()
+        return fresh
+
+    def recycle(self, car_tab, reason):
+        """在同一辆车上开一个新标签页替换旧的，释放旧页面积累的 DOM 和 JS 内存；开不了就继续用旧的"""
+        print(f"♻️ {car_tab} 需要换新标签页 ({reason})")
+        fresh = open_car_chat(self.browser, car_tab.car_id)
+        if not fresh:
+            return car_tab
+        try: car_tab.tab.close()
+        except: pass
+        self.slots[self.slots.index(car_tab)] = fresh
+        self.save()
+        return fresh
+
+    def acquire(self):
+        """阻塞直到有空闲的健康标签页；全部失效时返回 None"""
+        while self.slots:
+            car_tab = self.idle.get()
+            if not car_tab.healthy:
+                self.replace(car_tab)
+                continue
+            stats = self.stats.get(car_tab.car_id)
+            if stats and stats.degraded and time.time() - car_tab.migrate_checked_at >= MIGRATE_COOLDOWN:
+                car_tab = self.migrate(car_tab)
+            reason = car_tab.recycle_reason()
+            if reason:
+                car_tab = self.recycle(car_tab, reason)
+            return car_tab
+        return None
+
+    def release(self, car_tab):
+        self.idle.put(car_tab)
+
+    def drain(self):
+        """等所有工作线程把标签页还回来 (重启浏览器前调用)"""
+        for _ in range(len(self.slots)):
+            self.idle.get()
+
+def serve_request(pool, car_tab, mailbox, request):
+    """工作线程：在分配到的标签页里生成回复并回传"""
+    turn = tracing.Turn(request.get("turn"), source="j1800", car=car_tab.car_id)
+    if "poll_ms" in request:
+        turn.record("poll", request["poll_ms"])
+    started = time.perf_counter()
+    try:
+        if car_tab.needs_new_chat(request["user"]):
+            with turn.span("new_chat"):
+                car_tab.start_new_chat(pool.browser)
+        car_tab.user = request["user"]
+        car_tab.used = True
+        print(f"⏳ [{car_tab.car_id}] 等待回复...")
+        ans = ask(car_tab.tab, request["content"], turn)
+        car_tab.record_success()
+        pool.record(car_tab.car_id, time.perf_counter() - started, True)
+        msg = ans
+        print(f"🤖 [{car_tab.car_id}] 拿到回复，正在回传...")
+    except Exception as e:
+        car_tab.record_failure(e)
+        pool.record(car_tab.car_id, time.perf_counter() - started, False)
+        print(f"\n⚠️ [{car_tab.car_id}] 异常: {e}")
+        # 截断错误信息，避免报警内容过长
+        safe_msg = str(e).replace('\n', ' ')[:50]
+        msg = f"[⚠️ J1800 报警] {safe_msg}"
+    try:
+        with turn.span("put"):
+            mailbox.reply(request["id"], msg, turn.spans)
+        print(f"📤 [{car_tab.car_id}] 已回传")
+    except Exception as e:
+        print(f"\n⚠️ 回传失败: {e}")
+    finally:
+        turn.finish(ok=car_tab.failures == 0)
+        pool.release(car_tab)
+
+def launch_browser():
     co = ChromiumOptions()
     co.set_browser_path('/usr/bin/google-chrome')
     co.headless(True)
+    # 固定的资料目录：登录 cookie 重启后仍然有效，配合 bot_state.json 热启动
+    co.set_user_data_path(PROFILE_DIR)
     
     # J1800 性能优化参数
     co.set_argument('--no-sandbox')
     co.set_argument('--disable-gpu')
     co.set_argument('--disable-dev-shm-usage')
     co.set_argument('--mute-audio') 
+    co.no_imgs(True)
     
-    browser = ChromiumPage(co)
-    
-    try:
-        # ==========================================
-        # 1. 初始化 Tab 1: Gemini 车队
-        # ==========================================
-        tab_gemini = browser.latest_tab
-        tab_gemini.listen.start('geminiCarpage')
-        
-        print("🌍 [Tab 1] 正在访问车库...")
-        tab_gemini.get(TARGET_URL)
-        time.sleep(3)
-        
-        # 弹窗处理
-        if tab_gemini.ele('text:今日不再弹出', timeout=5):
-            tab_gemini.ele('text:今日不再弹出').click()
-            if tab_gemini.ele('text=确定'): tab_gemini.ele('text=确定').click()
-
-        # 选车逻辑
-        print("🔍 正在分析车况...")
-        res = tab_gemini.listen.wait(timeout=15)
-        if res:
-            car_list = res.response.body['data']['list']
-            pro_cars = [c for c in car_list if c['isPro'] == True and c['status'] == 1]
-            pro_cars.sort(key=lambda x: x['count'])
-            best_car = pro_cars[0]
-            print(f"🥇 选定最空闲车位: {best_car['carID']}")
-            
-            target_ele = tab_gemini.ele(f'text:{best_car["carID"]}', timeout=10)
-            if target_ele:
-                target_ele.click()
-            else:
-                tab_gemini.ele('text:Gemini').click()
-        else:
-            print("⚠️ 抓包超时，尝试盲点第一个车位...")
-            tab_gemini.ele('text:Gemini').click()
-            
-        print("🚀 正在前往聊天室...")
-        # J1800 might be slow, give it time to open tab/redirect
-        time.sleep(5)
-        
-        # IMPORTANT: Switch to the latest tab in case a new tab was opened
-        tab_gemini = browser.latest_tab
-        print(f"📍 当前页面: {tab_gemini.title}")
-        
-        # URL 跳转检查 (防止 J1800 响应慢导致还在车库页)
-        print("🔗 检查 URL 跳转状态...")
-        url_ok = False
-        for _ in range(15): # 等待 15 秒
-            if "/#/chat/" in tab_gemini.url:
-                print(f"✅ URL 确认: {tab_gemini.url}")
-                url_ok = True
-                break
-            time.sleep(1)
-        
-        if not url_ok:
-             print(f"⚠️ 警告: 15秒后 URL 仍未包含 /chat/ (当前: {tab_gemini.url})")
-
-        # Wait for chat input to confirm we are in
-        # Increased timeout for J1800
-        # Fix: Use .ele() directly which waits (DrissionPage syntax fix)
-        if not tab_gemini.ele('tag:textarea', timeout=45):
-                print("⚠️ 警告: 45秒内未找到输入框，尝试刷新页面...")
-                tab_gemini.refresh()
-                time.sleep(5)
-                # Check again
-                if not tab_gemini.ele('tag:textarea', timeout=30):
-                    print("❌ 严重错误: 无法加载聊天页面 (可能被重定向到了登录页)")
-        else:
-                print("✅ 成功抵达聊天页面")
-
-        print("🎯 等待 Gemini 3 Pro 模型就绪...")
-        # Wait for model selector
-        model_btn = tab_gemini.ele('text=Gemini', timeout=15)
-        if model_btn:
-            model_btn.click()
-            time.sleep(1)
-            # Try multiple selectors for the model
-            target_model = (tab_gemini.ele('text:3 Pro', timeout=5) or 
-                           tab_gemini.ele('text:Gemini 3 Pro', timeout=5) or
-                           tab_gemini.ele('text:1.5 Pro', timeout=5)) # Fallback
-            if target_model: 
-                target_model.click()
-                print("✅ 模型切换成功")
-            else:
-                print("⚠️ 未找到目标模型，保持默认")
-        else:
-            print("⚠️ 未找到模型切换按钮 (可能是移动端视图或已隐藏)")
-
-        # ==========================================
-        # 2. 初始化 Tab 2: 老贾云端信箱
-        # ==========================================
-        print("📮 [Tab 2] 正在打开老贾信箱...")
-        tab_laojia = browser.new_tab(f"{ZEABUR_URL}/?action=get&user={LAOJIA_USER}")
-        time.sleep(8) 
-
-        # ==========================================
-        # 3. 联动：自动打招呼 (Auto Hello)
-        # ==========================================
-        print("� 正在建立连接 (Auto Hello)...")
-        try:
-            input_box = tab_gemini.ele('@placeholder=输入消息') or tab_gemini.ele('tag:textarea')
-            if input_box:
-                # 发送上线通知，不作为对话内容，只是激活
-                # input_box.input("（系统：J1800 节点已上线，连接正常）")
-                # 暂时不发消息，避免打扰，或者仅打印日志
-                # 如果用户希望它是"老贾"，那应该由 api.py 的 prompt 决定。
-                # 这里我们只确保页面是活跃的。
-                pass
-        except:
-            pass
-
-        print("� 双线程就绪，开始搬运...")
-        
-        error_count = 0
-        
-        while True:
-            try:
-                # --- A: 刷新信箱 ---
-                tab_laojia.refresh()
-                time.sleep(3) 
-                
-                page_text = tab_laojia.ele('tag:body').text
-                
-                if "BRIDGE_DATA:" in page_text:
-                    try:
-                        json_str = page_text.split("BRIDGE_DATA:")[1].split(":END")[0]
-                        res_data = json.loads(json_str)
-                        
-                        if res_data.get("has_new"):
-                            question = res_data["content"]
-                            print(f"\n✨ [收到指令] {question}")
-                            
-                            # --- B: 直接操作 Tab 1 (不需要 activate) ---
-                            # DrissionPage 允许直接向后台标签页发送指令
-                            
-                            input_box = tab_gemini.ele('@placeholder=输入消息') or tab_gemini.ele('tag:textarea')
-                            if not input_box:
-                                print("❌ 严重错误: 未找到输入框 (可能车位已失效)，准备重启...")
-                                sys.exit(1) # 退出脚本，触发 run_bot.sh 重启
-                            input_box.input(question)
-                            
-                            send_btn = tab_gemini.ele('xpath://button[contains(., "发送")]') or tab_gemini.ele('@title=发送')
-                            send_btn.click()
-                            
-                            print("⏳ 等待回复...")
-                            time.sleep(15) # 等待生成
-                            
-                            replies = tab_gemini.eles('.content') or tab_gemini.eles('.message-content')
-                            if replies:
-                                ans = replies[-1].text
-                                print(f"🤖 拿到回复，正在回传...")
-                                
-                                # --- C: 用 Tab 2 回传 ---
-                                put_url = f"{ZEABUR_URL}/?action=put&user={LAOJIA_USER}&msg={ans}"
-                                tab_laojia.get(put_url)
-                                print("📤 已回传")
-                                
-                                # 回传完切回接收模式
-                                time.sleep(2)
-                                tab_laojia.get(f"{ZEABUR_URL}/?action=get&user={LAOJIA_USER}")
-                        else:
-                            # 没消息时显示个动态，证明脚本活着
-                            print("📡 暂无新消息...", end='\r')
-                            
-                    except Exception as parse_e:
-                         print(f"⚠️ 处理错误: {parse_e}")
-                         raise parse_e
-                else:
-                    print(f"⚠️ 页面加载中... (文本长度: {len(page_text)})", end='\r')
+    return ChromiumPage(co)
 
-            except Exception as e:
-                print(f"\n⚠️ 异常: {e}")
-                error_count += 1
-                if error_count >= 3: # 连续3次错误就报警
-                     try:
-                        print("🚨 发送报警信息...")
-                        # 必须对错误信息进行简单编码或截断，防止 URL 出错
-                        safe_msg = str(e).replace('\n', ' ')[:50]
-                        tab_laojia.get(f"{ZEABUR_URL}/?action=put&user={LAOJIA_USER}&msg=[⚠️ J1800 报警] {safe_msg}")
-                     except: pass
-                     
-                     print("🔄 连续错误，退出程序以触发重启...")
-                     break 
+def serve_forever(browser, mailbox, watchdog):
+    """用一个浏览器实例搬运请求；返回 True 表示需要重启浏览器后继续，False 表示退出"""
+    # ==========================================
+    # 1. 初始化车位池: N 个 Gemini 聊天标签页
+    # ==========================================
+    pool = CarPool(browser)
+    if not pool.start(POOL_SIZE):
+        print("❌ 严重错误: 没有可用的聊天页面，准备重启...")
+        sys.exit(1) # 退出脚本，触发 run_bot.sh 重启
 
+    print("🚚 车位池就绪，开始搬运...")
+    
+    error_count = 0
+    
+    while True:
+        # --- A: 先等到空闲标签页，再去信箱取请求 ---
+        car_tab = pool.acquire()
+        if car_tab is None:
+            print("❌ 所有车位均失效，退出程序以触发重启...")
+            return False
+        if watchdog.restart_requested.is_set():
+            pool.release(car_tab)
+            pool.drain()
+            return True
+        try:
+            poll_started = time.perf_counter()
+            res_data = mailbox.next()
+            error_count = 0
+        except Exception as e:
+            pool.release(car_tab)
+            print(f"\n⚠️ 信箱异常: {e}")
+            error_count += 1
+            if error_count >= 3: # 连续3次错误就重启
+                print("🔄 连续错误，退出程序以触发重启...")
+                return False
             time.sleep(5)
+            continue
+        
+        if res_data.get("has_new"):
+            res_data["poll_ms"] = (time.perf_counter() - poll_started) * 1000
+            # 问题内容不打到日志里，只记请求编号
+            print(f"\n✨ [收到指令] {res_data['id'][:8]} -> {car_tab.car_id}")
+            # --- B: 交给该标签页的工作线程，主线程继续取下一条 ---
+            threading.Thread(target=serve_request, args=(pool, car_tab, mailbox, res_data), daemon=True).start()
+        else:
+            pool.release(car_tab)
+            # 空闲时顺便刷新车况 (后台线程)，供换车和迁移打分
+            pool.maybe_refresh()
+            # 没消息时显示个动态，证明脚本活着
+            print(f"📡 暂无新消息... ({len(pool.slots)} 个车位)", end='\r')
 
+def run_laojia_bridge():
+    if not BRIDGE_URL:
+        print("❌ 未设置 LAOJIA_BRIDGE_URL (信箱接口地址)，无法取件，请在启动前 export 该变量")
+        sys.exit(2)
+    # 老贾云端信箱 (直接 HTTP，浏览器只负责车队页面)，浏览器重启时沿用
+    print("📮 正在连接老贾信箱...")
+    mailbox = Mailbox()
+    try:
+        mailbox.health()
     except Exception as e:
-        print(f"\n❌ 程序崩溃: {e}")
+        # 暂时连不上也先进入主循环，由连续错误计数决定是否重启
+        print(f"⚠️ 信箱暂时不可用: {e}")
+
+    while True:
+        browser = launch_browser()
+        watchdog = BrowserWatchdog()
+        watchdog.start()
+        restart = False
         try:
-             safe_msg = str(e).replace('\n', ' ')[:50]
-             browser.new_tab(f"{ZEABUR_URL}/?action=put&user={LAOJIA_USER}&msg=[☠️ J1800 崩溃] {safe_msg}")
-             time.sleep(5)
-        except: pass
-        browser.quit()
+            restart = serve_forever(browser, mailbox, watchdog)
+        except Exception as e:
+            print(f"\n❌ 程序崩溃: {e}")
+        finally:
+            watchdog.stop()
+            browser.quit()
+        if not restart:
+            break
+        print("♻️ 正在重启 Chromium...")
 
 if __name__ == "__main__":
-    run_laojia_bridge()
\ No newline at end of file
+    run_laojia_bridge()
@@ -0,0 +1,283 @@
+import os
+import json
+import fcntl
+import struct
+import threading
+from contextlib import contextmanager
+from storage_backend import StorageBackend
+
+# 聊天记录日志：memory.jsonl 每行一条消息，memory.idx 为每条消息的起始偏移 (8 字节小端)
+MEMORY_JOURNAL = "memory.jsonl"
+MEMORY_INDEX = "memory.idx"
+LEGACY_MEMORY = "memory.json"
+SUMMARY_FILE = "summary.json"
+PROFILE_FILE = "profile.json"
+IMAGES_META_FILE = "images.jsonl"
+_OFFSET = struct.Struct("<Q")
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def atomic_write_json(path, data, **dump_kwargs):
+    """Writes JSON to a temp file in the same folder, then renames it over the target"""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, **dump_kwargs)
+        _fsync(f)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def file_lock(path):
+    """Exclusive flock on path + ".lock", serializing writers across processes (threading locks only cover one)"""
+    # 锁文件单独存在：被锁的文件本身会被整体替换，锁在旧 inode 上就失效了
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _encode_message(msg):
+    return (json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8")
+
+class _UserRegistry:
+    """Process-wide cache of users.json, re-parsed only when its (inode, mtime, size) changes"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._users = {}
+        self._signature = None
+
+    def _stat_signature(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def snapshot(self):
+        with self._lock:
+            if not os.path.exists(self.path):
+                atomic_write_json(self.path, {})
+            signature = self._stat_signature()
+            if signature != self._signature:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._users = json.load(f)
+                self._signature = signature
+            return self._users
+
+    def get(self, username):
+        return self.snapshot().get(username)
+
+    def update(self, mutate):
+        """Runs mutate(users) on a copy and atomically replaces users.json with the result"""
+        with self._lock, file_lock(self.path):
+            # 拿到文件锁后 snapshot 会按签名重新读取，其他进程刚写入的用户不会被覆盖
+            users = dict(self.snapshot())
+            result = mutate(users)
+            # 缓存的条目是共享的，mutate 必须替换条目而不是原地修改
+            atomic_write_json(self.path, users, separators=(",", ":"))
+            self._users = users
+            self._signature = self._stat_signature()
+            return result
+
+class JsonBackend(StorageBackend):
+    """Files under data/: users.json, and per user profile.json, the memory journal and summary.json"""
+    def __init__(self, data_folder):
+        self.data_folder = data_folder
+        os.makedirs(os.path.join(data_folder, "users"), exist_ok=True)
+        self._users = _UserRegistry(os.path.join(data_folder, "users.json"))
+        self._locks = {}
+        self._locks_guard = threading.Lock()
+        self._journal_ready = set()
+
+    def _user_folder(self, username):
+        return os.path.join(self.data_folder, "users", username)
+
+    # --- users / tokens ---
+    def get_user(self, username):
+        return self._users.get(username)
+
+    def add_user(self, username, record):
+        def add(users):
+            if username in users:
+                return False
+            users[username] = record
+            return True
+        return username not in self._users.snapshot() and self._users.update(add)
+
+    def update_user(self, username, fields):
+        def merge(users):
+            if username not in users:
+                return False
+            users[username] = dict(users[username], **fields)
+            return True
+        return username in self._users.snapshot() and self._users.update(merge)
+
+    def list_usernames(self):
+        return list(self._users.snapshot())
+
+    # --- profiles ---
+    def save_profile(self, username, profile_data):
+        user_folder = self._user_folder(username)
+        os.makedirs(user_folder, exist_ok=True)
+        atomic_write_json(os.path.join(user_folder, PROFILE_FILE), profile_data, indent=2)
+
+    def load_profile(self, username):
+        profile_path = os.path.join(self._user_folder(username), PROFILE_FILE)
+        if os.path.exists(profile_path):
+            with open(profile_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        return {}
+
+    # --- messages ---
+    def _lock(self, username):
+        with self._locks_guard:
+            lock = self._locks.get(username)
+            if lock is None:
+                lock = self._locks[username] = threading.RLock()
+            return lock
+
+    def _journal_paths(self, username):
+        user_folder = self._user_folder(username)
+        return os.path.join(user_folder, MEMORY_JOURNAL), os.path.join(user_folder, MEMORY_INDEX)
+
+    def _write_journal(self, username, history):
+        """Atomically replaces the whole journal (used for migration and non-append rewrites)"""
+        data_path, idx_path = self._journal_paths(username)
+        with open(data_path + ".tmp", "wb") as data, open(idx_path + ".tmp", "wb") as idx:
+            for msg in history:
+                idx.write(_OFFSET.pack(data.tell()))
+                data.write(_encode_message(msg))
+            _fsync(data)
+            _fsync(idx)
+        # 先删索引再换数据：任何时刻崩溃，恢复时要么索引缺失(整体重建)，要么与数据一致
+        if os.path.exists(idx_path):
+            os.remove(idx_path)
+        os.replace(data_path + ".tmp", data_path)
+        os.replace(idx_path + ".tmp", idx_path)
+
+    @staticmethod
+    def _recover_journal(data_path, idx_path):
+        """Brings the offset index back in line with the journal after a crash"""
+        with open(data_path, "a+b") as data, open(idx_path, "a+b") as idx:
+            data_size = data.seek(0, os.SEEK_END)
+            count = idx.seek(0, os.SEEK_END) // _OFFSET.size
+            
+            # 丢弃指向数据末尾之外的索引，以及最后一条已索引消息（下面重新扫描确认它是完整的）
+            start = 0
+            while count:
+                count -= 1
+                idx.seek(count * _OFFSET.size)
+                start = _OFFSET.unpack(idx.read(_OFFSET.size))[0]
+                if start < data_size:
+                    break
+                start = 0
+            idx.truncate(count * _OFFSET.size)
+            
+            data.seek(start)
+            tail = data.read()
+            pos = 0
+            while True:
+                end = tail.find(b"\n", pos)
+                if end < 0:
+                    break
+                idx.write(_OFFSET.pack(start + pos))
+                pos = end + 1
+            if pos < len(tail):
+                # 写了一半的消息：截掉
+                data.truncate(start + pos)
+            _fsync(data)
+            _fsync(idx)
+
+    def _ensure_journal(self, username):
+        data_path, idx_path = self._journal_paths(username)
+        if username in self._journal_ready:
+            return data_path, idx_path
+        os.makedirs(self._user_folder(username), exist_ok=True)
+        
+        legacy_path = os.path.join(self._user_folder(username), LEGACY_MEMORY)
+        if not os.path.exists(data_path) and os.path.exists(legacy_path):
+            # 旧版 memory.json 一次性迁移为日志格式
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                try:
+                    legacy = json.load(f)
+                except:
+                    legacy = []
+            with file_lock(data_path):
+                self._write_journal(username, legacy)
+            os.replace(legacy_path, legacy_path + ".bak")
+        else:
+            with file_lock(data_path):
+                self._recover_journal(data_path, idx_path)
+        
+        self._journal_ready.add(username)
+        return data_path, idx_path
+
+    def message_count(self, username):
+        with self._lock(username):
+            _, idx_path = self._ensure_journal(username)
+            return os.path.getsize(idx_path) // _OFFSET.size
+
+    def read_messages(self, username, start=0, stop=None):
+        # 只读取索引定位到的字节范围
+        with self._lock(username):
+            data_path, idx_path = self._ensure_journal(username)
+            count = os.path.getsize(idx_path) // _OFFSET.size
+            start, stop, _ = slice(start, stop).indices(count)
+            if start >= stop:
+                return []
+            with open(idx_path, "rb") as idx:
+                idx.seek(start * _OFFSET.size)
+                offsets = [o for (o,) in _OFFSET.iter_unpack(idx.read((stop - start) * _OFFSET.size))]
+                end = _OFFSET.unpack(idx.read(_OFFSET.size))[0] if stop < count else None
+            with open(data_path, "rb") as data:
+                data.seek(offsets[0])
+                chunk = data.read() if end is None else data.read(end - offsets[0])
+        return [json.loads(line) for line in chunk.split(b"\n") if line]
+
+    def append_message(self, username, msg):
+        line = _encode_message(msg)
+        with self._lock(username):
+            data_path, idx_path = self._ensure_journal(username)
+            # 数据和索引两次写入必须对其他进程也是一个整体
+            with file_lock(data_path), open(data_path, "ab") as data:
+                offset = data.seek(0, os.SEEK_END)
+                data.write(line)
+                _fsync(data)
+                # 数据落盘后再写索引，崩溃时由 _recover_journal 补齐
+                with open(idx_path, "ab") as idx:
+                    msg_id = idx.seek(0, os.SEEK_END) // _OFFSET.size
+                    idx.write(_OFFSET.pack(offset))
+                    _fsync(idx)
+        return msg_id
+
+    def replace_messages(self, username, messages):
+        with self._lock(username):
+            data_path, _ = self._ensure_journal(username)
+            with file_lock(data_path):
+                self._write_journal(username, messages)
+
+    def load_summary(self, username):
+        summary_path = os.path.join(self._user_folder(username), SUMMARY_FILE)
+        if os.path.exists(summary_path):
+            with open(summary_path, "r", encoding="utf-8") as f:
+                try:
+                    return json.load(f)
+                except ValueError:
+                    pass
+        return {"upto": 0, "text": ""}
+
+    def save_summary(self, username, summary):
+        os.makedirs(self._user_folder(username), exist_ok=True)
+        atomic_write_json(os.path.join(self._user_folder(username), SUMMARY_FILE), summary, indent=2)
+
+    # --- image metadata ---
+    def record_image(self, username, rel_path, meta):
+        with open(os.path.join(self._user_folder(username), IMAGES_META_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(dict(meta, path=rel_path), ensure_ascii=False) + "\n")
+
+    def list_images(self, username):
+        meta_path = os.path.join(self._user_folder(username), IMAGES_META_FILE)
+        if not os.path.exists(meta_path):
+            return []
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
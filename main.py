@@ -1,12 +1,35 @@
-import streamlit as st
+import os
+import sys
+import io
 import json
 import time
-import auth
+import importlib
+import streamlit as st
 import storage
-import chat_utils
-import os
-from PIL import Image
-import google.generativeai as genai
+import bridge_server
+import car_queue
+import tracing
+import workers
+
+def lazy_import(name):
+    """Imports a module on first use and records how long the cold import took.
+
+    The bridge fast path below only needs storage and bridge_server; genai, PIL,
+    edge_tts and the auth UI are loaded once the interactive page actually needs them.
+    Set LAOJIA_IMPORT_REPORT=1 to also print the timings; they always land in the trace.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    t0 = time.perf_counter()
+    module = importlib.import_module(name)
+    elapsed_ms = (time.perf_counter() - t0) * 1000
+    tracing.record(None, "startup", f"import:{name}", elapsed_ms)
+    if os.environ.get("LAOJIA_IMPORT_REPORT"):
+        print(f"⏱️ import {name}: {elapsed_ms:.1f} ms")
+    return module
+
+# J1800 的 JSON 长轮询接口，随 Streamlit 进程一起启动 (每个进程只启动一次)
+bridge_server.start_in_background()
 
 # --- 0. 强力拦截逻辑：必须放在 st.set_page_config 之前 ---
 q_params = st.query_params
@@ -18,48 +41,40 @@ if "action" in q_params:
     
     if action == "get" and user:
         # 1. 取货逻辑
-        h = storage.load_memory(user)
-        res = {"has_new": False}
-        if h and h[-1]["role"] == "user":
-            p = h[-1]["parts"]
-            # 兼容多种格式提取文本 (优先找文本内容)
-            txt = ""
-            for part in p:
-                if isinstance(part, str):
-                    txt = part
-                    break
-                elif isinstance(part, dict) and part.get("type") == "text":
-                    txt = part.get("text", "")
-                    break
-            
-            if txt:
-                res = {"has_new": True, "content": txt}
+        res = bridge_server.pending_question(user)
         
-        # 2. 构造带特征标签的输出
+        # 2. 构造带特征标签的输出 (旧版接口，新版请用 bridge_server 的 /pending)
         st.write(f"BRIDGE_DATA:{json.dumps(res, ensure_ascii=False)}:END")
         st.stop() # 立即停止渲染
         
     elif action == "put" and user and "msg" in q_params:
         # 3. 还货逻辑
-        msg = q_params["msg"]
-        h = storage.load_memory(user)
-        if h and h[-1]["role"] == "user":
-            h.append({"role": "model", "parts": [{"type": "text", "text": msg}]})
-            storage.save_memory(user, h)
+        if bridge_server.put_reply(user, q_params["msg"]):
             st.write("BRIDGE_DATA:{\"status\":\"success\"}:END")
         st.stop()
 
 # --- 1. 正常 UI 页面配置 ---
 st.set_page_config(page_title="老贾 - 会说话的AI助理", page_icon="🎙️")
 
+auth = lazy_import("auth")
+chat_utils = lazy_import("chat_utils")
+
 if not auth.auth_flow():
     st.stop()
 
 username = st.session_state.username
-user_profile = storage.load_profile(username) or {}
+# 资料缓存在会话里，重跑时不读盘；修改延迟合并写入
+profile_cache = lazy_import("profile_cache")
+if st.session_state.get("profile_cache") is None or st.session_state.profile_cache.username != username:
+    st.session_state.profile_cache = profile_cache.ProfileCache(username)
+profile = st.session_state.profile_cache
+user_profile = profile.data
 
+# 只加载最近的一段记录，更早的按需翻页，渲染开销与总记录长度无关
+HISTORY_WINDOW = 30
 if "history" not in st.session_state:
-    st.session_state.history = storage.load_memory(username)
+    st.session_state.history_start, st.session_state.history = storage.load_recent(username, HISTORY_WINDOW)
+    st.session_state.history_window = HISTORY_WINDOW
 
 st.title(f"🎙️ 你的私人助理 - 老贾 ({user_profile.get('nickname', username)})")
 
@@ -69,6 +84,10 @@ with st.sidebar:
         auth.logout()
     st.divider()
     chat_utils.render_sound_check()
+    
+    with st.expander("⏱️ 响应耗时统计"):
+        if st.button("统计最近的耗时 (毫秒)"):
+            st.code(tracing.format_summary(tracing.summarize(tracing.load_spans())))
 
     st.divider()
     st.markdown("### ⚙️ 设置")
@@ -81,9 +100,7 @@ with st.sidebar:
     
     # 保存模式选择
     current_mode_code = "api" if "官方 API" in chat_mode else "car"
-    if user_profile.get("chat_mode") != current_mode_code:
-        user_profile["chat_mode"] = current_mode_code
-        storage.save_profile(username, user_profile)
+    profile.set("chat_mode", current_mode_code)
 
     # API Key 逻辑：用户设置优先 > 系统环境变量
     system_api_key = os.environ.get("GEMINI_API_KEY", "")
@@ -99,9 +116,7 @@ with st.sidebar:
         new_api_key = st.text_input(label, value=stored_user_key or "", type="password")
         
         if new_api_key != stored_user_key:
-            user_profile["api_key"] = new_api_key
-            storage.save_profile(username, user_profile)
-            st.rerun()
+            profile.set("api_key", new_api_key)
         
         # 如果用户清空了输入框，回退到系统 Key
         api_key = new_api_key if new_api_key else system_api_key
@@ -117,10 +132,22 @@ def display_message(msg):
             elif isinstance(part, dict):
                 if part.get("type") == "text": st.write(part["text"])
                 elif part.get("type") == "image":
-                    img_path = os.path.join("data", "users", username, part["path"])
+                    img_path = storage.image_file(username, part["path"], thumbnail=True)
                     if os.path.exists(img_path): st.image(img_path, width=300)
 
+# 窗口外的旧消息移出内存 (对话变长时窗口随之滑动)
+overflow = len(st.session_state.history) - st.session_state.history_window
+if overflow > 0:
+    del st.session_state.history[:overflow]
+    st.session_state.history_start += overflow
+
 with chat_container:
+    if st.session_state.history_start > 0:
+        if st.button("⬆️ 加载更早的消息"):
+            start, older = storage.load_before(username, st.session_state.history_start, HISTORY_WINDOW)
+            st.session_state.history[:0] = older
+            st.session_state.history_start = start
+            st.session_state.history_window += len(older)
     for msg in st.session_state.history:
         display_message(msg)
 
@@ -128,10 +155,16 @@ with st.expander("📷 拍照给老贾看", expanded=False):
     camera_img = st.camera_input("点击拍照", key="camera_input")
 
 if prompt := st.chat_input("和老贾说说话..."):
+    # 本轮各阶段耗时写入 data/traces，turn_id 随请求一起传给 J1800
+    turn = tracing.Turn(source="ui", mode=current_mode_code)
     user_display_parts = [{"type": "text", "text": prompt}]
+    # 图片编码和写盘交给后台线程，界面直接显示上传的原图；只有 API 模式发送前才需要等它写完
+    image_future = None
     if camera_img:
-        image = Image.open(camera_img)
-        rel_path = storage.save_image(username, image)
+        rel_path = storage.new_image_path(username)
+        image_bytes = camera_img.getvalue()
+        PIL_Image = lazy_import("PIL.Image")
+        image_future = workers.submit_io(lambda: storage.save_image(username, PIL_Image.open(io.BytesIO(image_bytes)), rel_path))
         user_display_parts.append({"type": "image", "path": rel_path})
 
     with chat_container:
@@ -139,8 +172,11 @@ if prompt := st.chat_input("和老贾说说话..."):
             st.write(prompt)
             if camera_img: st.image(camera_img, width=300)
     
-    st.session_state.history.append({"role": "user", "parts": user_display_parts})
-    storage.save_memory(username, st.session_state.history)
+    user_msg = {"role": "user", "parts": user_display_parts}
+    st.session_state.history.append(user_msg)
+    # 同一用户的写入走同一个 lane，保证问题一定先于回复落盘
+    with turn.span("save_user_msg"):
+        msg_id = workers.submit_io(storage.append_message, username, user_msg, lane=username).result()
     
     with chat_container:
         with st.chat_message("assistant"):
@@ -148,25 +184,41 @@ if prompt := st.chat_input("和老贾说说话..."):
             
             if current_mode_code == "car":
                 # --- 车队模式 (J1800) ---
+                if not bridge_server.start_in_background():
+                    # 信箱没起来时入队也没人取，别让用户干等到超时
+                    placeholder.error(f"💔 车队信箱未启动: {bridge_server.start_error}")
+                    turn.finish(ok=False, error="bridge_down")
+                    st.stop()
                 placeholder.markdown("⏳ 老贾正在通过 J1800 思考中...")
+                car_queue.enqueue(username, prompt, msg_id, turn.turn_id)
+                wait_started = time.perf_counter()
                 found_reply = False
-                for _ in range(45): # 最多等待90秒
-                    time.sleep(2)
-                    latest_history = storage.load_memory(username)
-                    if latest_history and latest_history[-1]["role"] == "model":
+                # bridge 写入回复时会唤醒这里，无需反复读取整份记录
+                deadline = time.monotonic() + car_queue.REPLY_TIMEOUT # 排队加生成的最长时间
+                cursor = msg_id + 1
+                while not found_reply and time.monotonic() < deadline:
+                    new_msgs = storage.wait_for_messages(username, cursor, deadline - time.monotonic())
+                    cursor += len(new_msgs)
+                    st.session_state.history.extend(new_msgs)
+                    for latest in new_msgs:
+                        if latest["role"] != "model":
+                            continue
                         # 兼容旧格式和新格式
-                        p = latest_history[-1]["parts"]
+                        p = latest["parts"]
                         answer = ""
                         if isinstance(p, list) and len(p) > 0 and isinstance(p[0], dict):
                             answer = p[0].get("text", "")
                         
+                        turn.since("bridge_wait", wait_started)
                         placeholder.markdown(answer)
-                        chat_utils.play_audio(answer)
-                        st.session_state.history = latest_history
+                        with turn.span("tts"):
+                            chat_utils.play_audio(answer)
                         found_reply = True
                         break
                 if not found_reply:
+                    turn.since("bridge_wait", wait_started, ok=False)
                     placeholder.error("💔 J1800 响应超时。")
+                turn.finish(ok=found_reply)
             
             else:
                 # --- 官方 API 模式 ---
@@ -176,53 +228,49 @@ if prompt := st.chat_input("和老贾说说话..."):
                 
                 try:
                     placeholder.markdown("⏳ 老贾正在思考...")
-                    genai.configure(api_key=api_key)
-                    
-                    # System Prompt
-                    sys_prompt = f"你是一个名为'老贾'的AI助手。你的主人是 {user_profile.get('nickname', username)}。你的性格是 {user_profile.get('style', '温馨')}。"
-                    
-                    model = genai.GenerativeModel("gemini-3-flash-preview", system_instruction=sys_prompt)
-                    
-                    # 构造历史记录 (排除最新一条，因为要传给 send_message)
-                    history_for_gemini = []
-                    for msg in st.session_state.history[:-1]:
-                        role = "user" if msg["role"] == "user" else "model"
-                        parts = []
-                        for p in msg["parts"]:
-                            if isinstance(p, dict):
-                                if p["type"] == "text": parts.append(p["text"])
-                                elif p["type"] == "image":
-                                    img_path = os.path.join("data", "users", username, p["path"])
-                                    if os.path.exists(img_path):
-                                        try: parts.append(Image.open(img_path))
-                                        except: pass
-                            else:
-                                parts.append(str(p))
-                        history_for_gemini.append({"role": role, "parts": parts})
-                    
-                    chat = model.start_chat(history=history_for_gemini)
+                    # 会话缓存在 session_state 里，只有 API Key / 风格 / 昵称变化时才重建
+                    gemini_session = lazy_import("gemini_session")
+                    search_index = lazy_import("search_index")
+                    session = st.session_state.get("gemini_session")
+                    if session is None or session.username != username or session.key != gemini_session.session_key(api_key, user_profile):
+                        session = st.session_state.gemini_session = gemini_session.GeminiSession(username, api_key, user_profile)
                     
-                    # 构造当前消息
-                    current_parts = []
-                    for p in st.session_state.history[-1]["parts"]:
-                        if p["type"] == "text": current_parts.append(p["text"])
-                        elif p["type"] == "image":
-                             img_path = os.path.join("data", "users", username, p["path"])
-                             if os.path.exists(img_path):
-                                 try: current_parts.append(Image.open(img_path))
-                                 except: pass
+                    if image_future:
+                        with turn.span("save_image"):
+                            image_future.result()
                     
-                    response_stream = chat.send_message(current_parts, stream=True)
+                    model_started = time.perf_counter()
+                    with turn.span("model_send"):
+                        response_stream = session.send(msg_id, user_msg)
                     
+                    # 边生成边分句合成语音，第一句写完就能开始播放
+                    speech = chat_utils.SpeechPipeline(turn=turn)
                     full_text = ""
+                    first_token = True
                     for chunk in response_stream:
+                        if first_token and chunk.text:
+                            turn.since("model_first_token", model_started)
+                            first_token = False
                         full_text += chunk.text
                         placeholder.markdown(full_text)
+                        speech.feed(chunk.text)
+                    turn.since("model_stream", model_started, chars=len(full_text))
                     
                     # 保存回复
-                    st.session_state.history.append({"role": "model", "parts": [{"type": "text", "text": full_text}]})
-                    storage.save_memory(username, st.session_state.history)
-                    chat_utils.play_audio(full_text)
+                    reply_msg = {"role": "model", "parts": [{"type": "text", "text": full_text}]}
+                    st.session_state.history.append(reply_msg)
+                    # 回复在后台落盘，写完再更新会话缓存；没赶上下一轮的话会话会按记录重建
+                    def store_reply(session=session, reply_msg=reply_msg):
+                        session.commit(storage.append_message(username, reply_msg), reply_msg)
+                        # 顺手把这一问一答加进检索索引，下一轮查询时就不用再补
+                        search_index.catch_up(username)
+                    workers.submit_io(store_reply, lane=username)
+                    with turn.span("tts_finish"):
+                        speech.finish()
+                    turn.finish()
                     
                 except Exception as e:
+                    turn.finish(ok=False, error=str(e)[:200])
+                    if st.session_state.get("gemini_session"):
+                        st.session_state.gemini_session.reset()
                     placeholder.error(f"API 调用失败: {e}")
\ No newline at end of file
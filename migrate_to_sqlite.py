@@ -0,0 +1,68 @@
+import os
+import argparse
+import storage
+from json_backend import JsonBackend
+from sqlite_backend import SQLiteBackend
+
+# 一次性把 data/ 下的 JSON 存储迁移到 SQLite:
+#   python migrate_to_sqlite.py [--force]
+# 迁移完成后设置环境变量 LAOJIA_STORAGE=sqlite 再启动应用
+
+def _user_folders(data_folder):
+    users_folder = os.path.join(data_folder, "users")
+    if not os.path.isdir(users_folder):
+        return []
+    return [name for name in os.listdir(users_folder) if os.path.isdir(os.path.join(users_folder, name))]
+
+def _legacy_images(source, username):
+    # 旧图片没有元数据记录，按文件补一条
+    images_folder = os.path.join(source.data_folder, "users", username, "images")
+    if not os.path.isdir(images_folder):
+        return []
+    recorded = {img["path"] for img in source.list_images(username)}
+    found = []
+    for name in sorted(os.listdir(images_folder)):
+        rel_path = f"images/{name}"
+        if name.endswith(".jpg") and not name.endswith(storage.THUMB_SUFFIX) and rel_path not in recorded:
+            full_path = os.path.join(images_folder, name)
+            found.append((rel_path, {"bytes": os.path.getsize(full_path), "created_at": os.path.getmtime(full_path)}))
+    return found
+
+def migrate(data_folder, db_path, force=False):
+    source = JsonBackend(data_folder)
+    target = SQLiteBackend(db_path)
+    existing = set(target.list_usernames())
+    
+    usernames = sorted(set(source.list_usernames()) | set(_user_folders(data_folder)))
+    migrated = 0
+    for username in usernames:
+        if username in existing and not force:
+            print(f"⏭️  {username}: 已存在，跳过 (用 --force 覆盖)")
+            continue
+        record = source.get_user(username)
+        if record:
+            if not target.add_user(username, record):
+                target.update_user(username, record)
+        profile = source.load_profile(username)
+        if profile:
+            target.save_profile(username, profile)
+        messages = source.read_messages(username)
+        target.replace_messages(username, messages)
+        summary = source.load_summary(username)
+        if summary.get("text"):
+            target.save_summary(username, summary)
+        images = [(img["path"], {k: v for k, v in img.items() if k != "path"}) for img in source.list_images(username)]
+        images += _legacy_images(source, username)
+        for rel_path, meta in images:
+            target.record_image(username, rel_path, meta)
+        migrated += 1
+        print(f"✅ {username}: {len(messages)} 条消息, {len(images)} 张图片")
+    print(f"🎉 迁移完成: {migrated}/{len(usernames)} 个用户 -> {db_path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate LaoJia JSON storage to SQLite")
+    parser.add_argument("--data", default=storage.DATA_FOLDER)
+    parser.add_argument("--db", default=storage.SQLITE_FILE)
+    parser.add_argument("--force", action="store_true", help="overwrite users that already exist in the database")
+    args = parser.parse_args()
+    migrate(args.data, args.db, args.force)
@@ -0,0 +1,37 @@
+import threading
+import time
+
+# 进程内的等待/唤醒登记表：按 key (如用户名) 分配 Condition
+_conditions = {}
+_conditions_guard = threading.Lock()
+
+def _condition(key):
+    with _conditions_guard:
+        cond = _conditions.get(key)
+        if cond is None:
+            cond = _conditions[key] = threading.Condition()
+        return cond
+
+def signal(key):
+    """Wakes every thread waiting on key in this process"""
+    cond = _condition(key)
+    with cond:
+        cond.notify_all()
+
+def wait_until(key, predicate, timeout, poll_interval=1.0):
+    """Blocks until predicate() is truthy and returns its value, or None after timeout.
+
+    signal(key) wakes waiters immediately; predicate is also re-checked every
+    poll_interval seconds so writers in other processes are noticed too.
+    """
+    deadline = time.monotonic() + timeout
+    cond = _condition(key)
+    with cond:
+        while True:
+            result = predicate()
+            if result:
+                return result
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            cond.wait(min(remaining, poll_interval))
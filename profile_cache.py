@@ -0,0 +1,62 @@
+import atexit
+import weakref
+import threading
+import storage
+
+# 设置变更先记在内存里，停止编辑 PROFILE_FLUSH_DELAY 秒后合并写盘一次
+PROFILE_FLUSH_DELAY = 2.0
+
+_live_caches = weakref.WeakSet()
+
+class ProfileCache:
+    """A user's profile kept in st.session_state with dirty-field tracking and debounced write-behind.
+
+    Reruns read from memory; set() only marks a field dirty and (re)starts the flush timer,
+    so a burst of edits becomes one write. The flush merges just the dirty fields into the
+    latest profile on disk, so edits from another device to other fields are not lost.
+    """
+    def __init__(self, username, delay=PROFILE_FLUSH_DELAY):
+        self.username = username
+        self.delay = delay
+        self.data = storage.load_profile(username) or {}
+        self.dirty = set()
+        self._lock = threading.Lock()
+        self._timer = None
+        _live_caches.add(self)
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        if self.data.get(key) == value and key not in self.dirty:
+            return
+        with self._lock:
+            self.data[key] = value
+            self.dirty.add(key)
+            if self._timer:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Writes pending changes now (no-op when nothing is dirty)"""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if not self.dirty:
+                return
+            changes = {key: self.data[key] for key in self.dirty}
+            self.dirty.clear()
+            latest = storage.load_profile(self.username) or {}
+            latest.update(changes)
+            storage.save_profile(self.username, latest)
+
+@atexit.register
+def flush_all():
+    for cache in list(_live_caches):
+        try:
+            cache.flush()
+        except Exception:
+            pass
@@ -0,0 +1,190 @@
+import os
+import re
+import math
+import json
+import hashlib
+import threading
+import storage
+from json_backend import file_lock
+
+# 每个用户一份倒排索引，让老贾能从很久以前的对话里找回相关内容，而不必把全部记录发给模型。
+# 索引文件 data/users/<name>/search_index.jsonl 每行对应一条消息 (按消息 id 顺序)，只追加；
+# 查询前先把日志里还没索引的消息补上，所以无论谁写入的消息 (车队模式、其他设备) 都能搜到。
+# 索引随时可以从日志重建：读到坏行 (写到一半断电等) 就整份丢掉重建，所以不需要 fsync。
+INDEX_FILE = "search_index.jsonl"
+TOP_K = 4
+# 阈值都是相对的：BM25 的绝对分数随记录长短变化很大，短记录里 IDF 小，固定分数线会把真命中全筛掉
+MIN_COVERAGE = 0.25 # 最佳命中至少要达到这句话理论满分的这个比例，否则多半只是撞上了常用词
+RELATIVE_CUTOFF = 0.5 # 其余命中不低于最佳命中的这个比例
+BM25_K1 = 1.2
+BM25_B = 0.75
+READ_PAGE = 256
+RECALL_MAX_CHARS = 200
+
+# 中文按相邻两字切分 (单字成段时保留单字)，英文和数字按整词
+_RUNS = re.compile(r'[\u4e00-\u9fff]+|[a-z0-9]+')
+
+def tokenize(text):
+    terms = []
+    for run in _RUNS.findall(text.lower()):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+def _digest(msg):
+    return hashlib.sha1(storage.message_text(msg).encode("utf-8")).hexdigest()[:12]
+
+def _index_path(username):
+    return os.path.join(storage.DATA_FOLDER, "users", username, INDEX_FILE)
+
+class _UserIndex:
+    """In-memory BM25 postings for one user, mirrored by the append-only index file"""
+    def __init__(self, username):
+        self.username = username
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.postings = {} # term -> [(msg_id, tf)]
+        self.lengths = [] # msg_id -> 词数
+        self.digests = []
+        self.total_len = 0
+        self.offset = 0 # 已读到的文件位置
+        self.inode = None
+
+    @property
+    def upto(self):
+        return len(self.lengths)
+
+    def _add(self, entry):
+        msg_id = self.upto
+        for term, tf in entry["tf"].items():
+            self.postings.setdefault(term, []).append((msg_id, tf))
+        self.lengths.append(entry["len"])
+        self.digests.append(entry["h"])
+        self.total_len += entry["len"]
+
+    def _sync_file(self, path):
+        """Loads entries other processes appended since the last read; returns False if the file is corrupt"""
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self._reset()
+            return True
+        if st.st_ino != self.inode or st.st_size < self.offset:
+            self._reset()
+            self.inode = st.st_ino
+        if st.st_size == self.offset:
+            return True
+        with open(path, "rb") as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1 # 只处理完整的行，写了一半的留到下次
+        for line in data[:end].split(b"\n"):
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+                # 自己刚追加的、或者多个进程重复补的行，按 id 去重
+                if entry["id"] == self.upto:
+                    self._add(entry)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                return False
+        self.offset += end
+        return True
+
+    def catch_up(self):
+        path = _index_path(self.username)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 多个进程可能同时补同一份索引，加锁保证每行完整、不交错
+        with file_lock(path):
+            self._catch_up_locked(path)
+
+    def _catch_up_locked(self, path):
+        intact = self._sync_file(path)
+        count = storage.message_count(self.username)
+        # 文件里有坏行，或者记录被整体替换过 (变短或最后一条对不上)：丢掉索引重建
+        if not intact or count < self.upto or (self.upto and _digest(storage.read_messages(self.username, self.upto - 1, self.upto)[0]) != self.digests[-1]):
+            if os.path.exists(path):
+                os.remove(path)
+            self._reset()
+        if count == self.upto:
+            return
+        with open(path, "ab") as f:
+            while self.upto < count:
+                lines = []
+                for msg in storage.read_messages(self.username, self.upto, min(count, self.upto + READ_PAGE)):
+                    terms = tokenize(storage.message_text(msg))
+                    tf = {}
+                    for term in terms:
+                        tf[term] = tf.get(term, 0) + 1
+                    entry = {"id": self.upto, "tf": tf, "len": len(terms), "h": _digest(msg)}
+                    lines.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n")
+                    self._add(entry)
+                # 索引可以从日志重建，不需要 fsync
+                f.write("".join(lines).encode("utf-8"))
+        if self.inode is None:
+            self.inode = os.stat(path).st_ino
+
+    def search(self, query, k, before):
+        n = self.upto
+        if not n or not self.total_len:
+            return []
+        avg_len = self.total_len / n
+        scores = {}
+        ideal = 0.0 # 每个查询词都命中且词频很高时的分数上限
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                # 记录里从没出现过的词谁也命中不了，不计入满分
+                continue
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            ideal += idf * (BM25_K1 + 1)
+            for msg_id, tf in postings:
+                if before is not None and msg_id >= before:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[msg_id] / avg_len)
+                scores[msg_id] = scores.get(msg_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if not ranked or ranked[0][1] < MIN_COVERAGE * ideal:
+            return []
+        floor = ranked[0][1] * RELATIVE_CUTOFF
+        return [(msg_id, score) for msg_id, score in ranked[:k] if score >= floor]
+
+_indexes = {}
+_indexes_guard = threading.Lock()
+
+def _get_index(username):
+    with _indexes_guard:
+        index = _indexes.get(username)
+        if index is None:
+            index = _indexes[username] = _UserIndex(username)
+        return index
+
+def catch_up(username):
+    """Indexes any messages appended since the last call (cheap when there are none)"""
+    index = _get_index(username)
+    with index.lock:
+        index.catch_up()
+
+def search(username, query, k=TOP_K, before=None):
+    """Returns up to k (msg_id, score) pairs best matching query, ignoring messages at or after `before`"""
+    index = _get_index(username)
+    with index.lock:
+        index.catch_up()
+        return index.search(query, k, before)
+
+def recall(username, query, k=TOP_K, before=None):
+    """Returns the matching messages as [(msg_id, msg)] in chronological order"""
+    hits = sorted(msg_id for msg_id, _ in search(username, query, k, before))
+    return [(msg_id, storage.read_messages(username, msg_id, msg_id + 1)[0]) for msg_id in hits]
+
+def format_recall(recalled):
+    """Renders recalled messages as a short note to put in front of the user's turn"""
+    lines = ["(以下是和这句话相关的往事，仅供参考，不必逐条回应)"]
+    for _, msg in recalled:
+        speaker = "主人" if msg["role"] == "user" else "老贾"
+        lines.append(f"{speaker}: {storage.message_text(msg)[:RECALL_MAX_CHARS]}")
+    return "\n".join(lines)
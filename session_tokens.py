@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import hmac
+import uuid
+import base64
+import hashlib
+import threading
+from json_backend import atomic_write_json
+
+# 无状态的登录令牌: base64(载荷).base64(HMAC-SHA256)，校验只需密钥，不读用户表
+# 密钥优先取环境变量 LAOJIA_SECRET，否则在数据目录生成并持久化一份
+TOKEN_TTL = 30 * 24 * 3600
+SECRET_FILE = "secret.key"
+REVOKED_FILE = "revoked_tokens.json"
+
+_lock = threading.RLock()
+_secret = None
+_revoked = {} # jti -> exp
+_revoked_signature = None
+
+def _data_path(name):
+    import storage
+    return os.path.join(storage.DATA_FOLDER, name)
+
+def _get_secret():
+    global _secret
+    if _secret is None:
+        with _lock:
+            env_secret = os.environ.get("LAOJIA_SECRET")
+            if env_secret:
+                _secret = env_secret.encode("utf-8")
+            else:
+                path = _data_path(SECRET_FILE)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    # O_EXCL: 多个进程同时启动时只有一个能创建
+                    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+                    with os.fdopen(fd, "w") as f:
+                        f.write(os.urandom(32).hex())
+                except FileExistsError:
+                    pass
+                with open(path, "r") as f:
+                    _secret = f.read().strip().encode("utf-8")
+    return _secret
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _sign(payload):
+    return _b64encode(hmac.new(_get_secret(), payload.encode("ascii"), hashlib.sha256).digest())
+
+def issue(username, ttl=TOKEN_TTL):
+    """Returns a signed token for username that expires after ttl seconds"""
+    claims = {"u": username, "exp": int(time.time() + ttl), "jti": uuid.uuid4().hex}
+    payload = _b64encode(json.dumps(claims, separators=(",", ":"), ensure_ascii=False).encode("utf-8"))
+    return f"{payload}.{_sign(payload)}"
+
+def decode(token):
+    """Returns the claims of a correctly signed token (expired or not), or None"""
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        return json.loads(_b64decode(payload))
+    except (ValueError, AttributeError):
+        return None
+
+def _load_revoked():
+    """Refreshes the in-memory revocation list when the file on disk changed"""
+    global _revoked, _revoked_signature
+    path = _data_path(REVOKED_FILE)
+    try:
+        st = os.stat(path)
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    except FileNotFoundError:
+        signature = None
+    if signature != _revoked_signature:
+        with _lock:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    _revoked = json.load(f)
+            except (FileNotFoundError, ValueError):
+                _revoked = {}
+            _revoked_signature = signature
+    return _revoked
+
+def verify(username, token):
+    claims = decode(token)
+    return bool(claims) and claims.get("u") == username and claims.get("exp", 0) > time.time() \
+        and claims.get("jti") not in _load_revoked()
+
+def revoke(token):
+    """Adds a token to the revocation list (kept only until the token would have expired anyway)"""
+    claims = decode(token)
+    if not claims:
+        return False
+    now = time.time()
+    with _lock:
+        revoked = {jti: exp for jti, exp in _load_revoked().items() if exp > now}
+        revoked[claims["jti"]] = claims.get("exp", now + TOKEN_TTL)
+        atomic_write_json(_data_path(REVOKED_FILE), revoked)
+    return True
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from storage_backend import StorageBackend
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS profiles (
+    username TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    username TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    parts TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (username, seq)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS summaries (
+    username TEXT PRIMARY KEY,
+    upto INTEGER NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    username TEXT NOT NULL,
+    path TEXT NOT NULL,
+    meta TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (username, path)
+);
+"""
+
+class SQLiteBackend(StorageBackend):
+    """Single SQLite database in WAL mode; messages are keyed by (username, seq) for indexed range reads"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._local = threading.local()
+        with self._conn(write=True) as conn:
+            for statement in _SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+
+    def _conn(self, write=False):
+        # sqlite3 连接不能跨线程共享，每个线程一条
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return _Transaction(conn, write)
+
+    # --- users / tokens ---
+    def get_user(self, username):
+        with self._conn() as conn:
+            row = conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def add_user(self, username, record):
+        with self._conn(write=True) as conn:
+            cur = conn.execute("INSERT OR IGNORE INTO users (username, data) VALUES (?, ?)",
+                               (username, json.dumps(record, ensure_ascii=False)))
+            return cur.rowcount == 1
+
+    def update_user(self, username, fields):
+        with self._conn(write=True) as conn:
+            row = conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+            if not row:
+                return False
+            record = dict(json.loads(row[0]), **fields)
+            conn.execute("UPDATE users SET data = ? WHERE username = ?", (json.dumps(record, ensure_ascii=False), username))
+            return True
+
+    def list_usernames(self):
+        with self._conn() as conn:
+            return [r[0] for r in conn.execute("SELECT username FROM users ORDER BY username")]
+
+    # --- profiles ---
+    def load_profile(self, username):
+        with self._conn() as conn:
+            row = conn.execute("SELECT data FROM profiles WHERE username = ?", (username,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def save_profile(self, username, profile_data):
+        with self._conn(write=True) as conn:
+            conn.execute("INSERT OR REPLACE INTO profiles (username, data) VALUES (?, ?)",
+                         (username, json.dumps(profile_data, ensure_ascii=False)))
+
+    # --- messages ---
+    def _count(self, conn, username):
+        # seq 从 0 连续递增，主键索引上取 MAX 是 O(log n)
+        row = conn.execute("SELECT MAX(seq) FROM messages WHERE username = ?", (username,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def message_count(self, username):
+        with self._conn() as conn:
+            return self._count(conn, username)
+
+    def read_messages(self, username, start=0, stop=None):
+        with self._conn() as conn:
+            if start is not None and start < 0 or stop is not None and stop < 0:
+                start, stop, _ = slice(start, stop).indices(self._count(conn, username))
+            start = start or 0
+            rows = conn.execute(
+                "SELECT role, parts FROM messages WHERE username = ? AND seq >= ? AND seq < ? ORDER BY seq",
+                (username, start, stop if stop is not None else 2 ** 62)).fetchall()
+        return [{"role": role, "parts": json.loads(parts)} for role, parts in rows]
+
+    def _insert(self, conn, username, seq, msg):
+        conn.execute("INSERT INTO messages (username, seq, role, parts, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (username, seq, msg["role"], json.dumps(msg["parts"], ensure_ascii=False), time.time()))
+
+    def append_message(self, username, msg):
+        with self._conn(write=True) as conn:
+            msg_id = self._count(conn, username)
+            self._insert(conn, username, msg_id, msg)
+        return msg_id
+
+    def replace_messages(self, username, messages):
+        with self._conn(write=True) as conn:
+            conn.execute("DELETE FROM messages WHERE username = ?", (username,))
+            for seq, msg in enumerate(messages):
+                self._insert(conn, username, seq, msg)
+
+    def load_summary(self, username):
+        with self._conn() as conn:
+            row = conn.execute("SELECT upto, text FROM summaries WHERE username = ?", (username,)).fetchone()
+        return {"upto": row[0], "text": row[1]} if row else {"upto": 0, "text": ""}
+
+    def save_summary(self, username, summary):
+        with self._conn(write=True) as conn:
+            conn.execute("INSERT OR REPLACE INTO summaries (username, upto, text) VALUES (?, ?, ?)",
+                         (username, summary.get("upto", 0), summary.get("text", "")))
+
+    # --- image metadata ---
+    def record_image(self, username, rel_path, meta):
+        with self._conn(write=True) as conn:
+            conn.execute("INSERT OR REPLACE INTO images (username, path, meta, created_at) VALUES (?, ?, ?, ?)",
+                         (username, rel_path, json.dumps(meta, ensure_ascii=False), meta.get("created_at", time.time())))
+
+    def list_images(self, username):
+        with self._conn() as conn:
+            rows = conn.execute("SELECT path, meta FROM images WHERE username = ? ORDER BY created_at", (username,)).fetchall()
+        return [dict(json.loads(meta), path=path) for path, meta in rows]
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT around a write block; reads run in autocommit mode so WAL readers never block"""
+    def __init__(self, conn, write):
+        self.conn = conn
+        self.write = write
+        self.outer = False
+
+    def __enter__(self):
+        if self.write and not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.outer = True
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.outer:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
@@ -1,11 +1,29 @@
 import os
-import json
+import time
 import hashlib
+import hmac
 import uuid
-from PIL import Image
+import threading
+import notify
+import session_tokens
 
 DATA_FOLDER = "data"
 USERS_FILE = os.path.join(DATA_FOLDER, "users.json")
+SQLITE_FILE = os.path.join(DATA_FOLDER, "laojia.db")
+
+# 存储后端：json (默认，data/ 下的文件) 或 sqlite (WAL 模式的 data/laojia.db)
+# 从 JSON 切换到 SQLite 前先运行一次: python migrate_to_sqlite.py
+STORAGE_BACKEND = os.environ.get("LAOJIA_STORAGE", "json")
+
+# 图片入库时生成两份衍生图：给模型的限尺寸版本 (作为主文件) 和界面用的小缩略图
+MODEL_IMAGE_MAX_SIDE = 1024
+MODEL_IMAGE_QUALITY = 85
+THUMB_MAX_SIDE = 320
+THUMB_QUALITY = 75
+THUMB_SUFFIX = "_thumb.jpg"
+
+_memory_locks = {}
+_memory_locks_guard = threading.Lock()
 
 def _get_user_folder(username):
     return os.path.join(DATA_FOLDER, "users", username)
@@ -15,39 +33,50 @@ def _get_images_folder(username):
     os.makedirs(folder, exist_ok=True)
     return folder
 
+def create_backend(kind=None):
+    kind = kind or STORAGE_BACKEND
+    if kind == "sqlite":
+        from sqlite_backend import SQLiteBackend
+        return SQLiteBackend(SQLITE_FILE)
+    if kind == "json":
+        from json_backend import JsonBackend
+        return JsonBackend(DATA_FOLDER)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+_backend = None
+
+def configure(data_folder=None, backend=None):
+    """Points storage at another data folder and/or backend (benchmarks, migrations); resets the active backend"""
+    global DATA_FOLDER, USERS_FILE, SQLITE_FILE, STORAGE_BACKEND, _backend
+    if data_folder is not None:
+        DATA_FOLDER = data_folder
+        USERS_FILE = os.path.join(DATA_FOLDER, "users.json")
+        SQLITE_FILE = os.path.join(DATA_FOLDER, "laojia.db")
+    if backend is not None:
+        STORAGE_BACKEND = backend
+    _backend = None
+
 def init_storage():
-    if not os.path.exists(DATA_FOLDER):
-        os.makedirs(DATA_FOLDER)
-    if not os.path.exists(os.path.join(DATA_FOLDER, "users")):
-        os.makedirs(os.path.join(DATA_FOLDER, "users"))
-    if not os.path.exists(USERS_FILE):
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump({}, f)
+    global _backend
+    if _backend is None:
+        os.makedirs(os.path.join(DATA_FOLDER, "users"), exist_ok=True)
+        _backend = create_backend()
+    return _backend
+
+def _hash_password(password):
+    # Simple hash for password
+    return hashlib.sha256(password.encode()).hexdigest()
 
 def get_user(username):
-    init_storage()
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        users = json.load(f)
-    return users.get(username)
+    return init_storage().get_user(username)
 
 def create_user(username, password, profile_data=None):
-    init_storage()
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        users = json.load(f)
-    
-    if username in users:
-        return False, "用户已存在"
-    
-    # Simple hash for password
-    hashed_pw = hashlib.sha256(password.encode()).hexdigest()
-    
-    users[username] = {
-        "password": hashed_pw,
-        "created_at": str(os.path.getctime(USERS_FILE)) # Dummy timestamp logic, improved later
+    record = {
+        "password": _hash_password(password),
+        "created_at": str(time.time())
     }
-    
-    with open(USERS_FILE, "w", encoding="utf-8") as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
+    if not init_storage().add_user(username, record):
+        return False, "用户已存在"
         
     # Create user specific folder and profile
     user_folder = _get_user_folder(username)
@@ -59,92 +88,198 @@ def create_user(username, password, profile_data=None):
     return True, "注册成功"
 
 def update_session_token(username):
-    init_storage()
-    with open(USERS_FILE, "r", encoding="utf-8") as f:
-        users = json.load(f)
-    
-    if username in users:
-        token = str(uuid.uuid4())
-        users[username]["token"] = token
-        with open(USERS_FILE, "w", encoding="utf-8") as f:
-            json.dump(users, f, ensure_ascii=False, indent=2)
-        return token
-    return None
+    """Issues a signed, expiring login token; nothing is written, so each device keeps its own"""
+    if not get_user(username):
+        return None
+    return session_tokens.issue(username)
 
-def verify_session_token(username, token):
+def _legacy_token_matches(username, token):
+    # 旧版令牌是存在用户表里的 UUID，不会过期，也进不了吊销名单
     user = get_user(username)
-    if user and user.get("token") == token:
-        return True
-    return False
+    stored = user.get("token") if user else None
+    return bool(stored) and hmac.compare_digest(stored, token)
+
+def verify_session_token(username, token):
+    if not token:
+        return False
+    if "." in token:
+        return session_tokens.verify(username, token)
+    return _legacy_token_matches(username, token)
+
+def exchange_session_token(username, token):
+    """Returns a valid signed token for a cookie login, or None if the token is not valid.
+
+    Signed tokens come back unchanged; a legacy UUID token is accepted exactly once and
+    swapped for a signed one, and the UUID is cleared so the old cookie stops working.
+    """
+    if not token:
+        return None
+    if "." in token:
+        return token if session_tokens.verify(username, token) else None
+    if not _legacy_token_matches(username, token):
+        return None
+    init_storage().update_user(username, {"token": None})
+    return session_tokens.issue(username)
+
+def revoke_session_token(token, username=None):
+    if token and "." not in token:
+        # 旧版令牌：直接从用户表清掉
+        if username and _legacy_token_matches(username, token):
+            return init_storage().update_user(username, {"token": None})
+        return False
+    return session_tokens.revoke(token)
 
 def verify_user(username, password):
     user = get_user(username)
     if not user:
         return False
-    hashed_pw = hashlib.sha256(password.encode()).hexdigest()
-    return user["password"] == hashed_pw
+    return user["password"] == _hash_password(password)
 
 def save_profile(username, profile_data):
-    user_folder = _get_user_folder(username)
-    os.makedirs(user_folder, exist_ok=True)
-    with open(os.path.join(user_folder, "profile.json"), "w", encoding="utf-8") as f:
-        json.dump(profile_data, f, ensure_ascii=False, indent=2)
+    init_storage().save_profile(username, profile_data)
 
 def load_profile(username):
-    user_folder = _get_user_folder(username)
-    profile_path = os.path.join(user_folder, "profile.json")
-    if os.path.exists(profile_path):
-        with open(profile_path, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {}
-
-def save_image(username, image):
-    """Saves a PIL image and returns the relative path"""
+    return init_storage().load_profile(username)
+
+def new_image_path(username):
+    """Reserves a relative path for an image that save_image will write later (e.g. on a worker thread)"""
+    return f"images/{uuid.uuid4()}.jpg"
+
+def save_image(username, image, rel_path=None):
+    """Saves a PIL image as a bounded model-input JPEG plus a display thumbnail, returns the relative path"""
     images_folder = _get_images_folder(username)
-    filename = f"{uuid.uuid4()}.jpg"
-    filepath = os.path.join(images_folder, filename)
-    image.save(filepath)
-    return f"images/{filename}"
+    rel_path = rel_path or new_image_path(username)
+    image_id = os.path.splitext(os.path.basename(rel_path))[0]
+    
+    # JPEG 不支持透明通道 (摄像头有时给 RGBA)
+    image = image.convert("RGB")
+    model_image = image.copy()
+    model_image.thumbnail((MODEL_IMAGE_MAX_SIDE, MODEL_IMAGE_MAX_SIDE))
+    model_path = os.path.join(images_folder, f"{image_id}.jpg")
+    model_image.save(model_path, quality=MODEL_IMAGE_QUALITY, optimize=True)
+    width, height = model_image.size
+    
+    model_image.thumbnail((THUMB_MAX_SIDE, THUMB_MAX_SIDE))
+    thumb_path = os.path.join(images_folder, f"{image_id}{THUMB_SUFFIX}")
+    model_image.save(thumb_path, quality=THUMB_QUALITY, optimize=True)
+    
+    init_storage().record_image(username, rel_path, {
+        "thumb": f"images/{image_id}{THUMB_SUFFIX}",
+        "width": width,
+        "height": height,
+        "bytes": os.path.getsize(model_path),
+        "thumb_bytes": os.path.getsize(thumb_path),
+        "created_at": time.time(),
+    })
+    return rel_path
 
-def save_memory(username, history):
-    user_folder = _get_user_folder(username)
-    os.makedirs(user_folder, exist_ok=True)
+def image_file(username, rel_path, thumbnail=False):
+    """Returns the on-disk path for an image part, preferring the thumbnail for display when it exists"""
+    path = os.path.join(_get_user_folder(username), rel_path)
+    if thumbnail:
+        thumb_path = os.path.splitext(path)[0] + THUMB_SUFFIX
+        # 旧图片没有缩略图，回退到原图
+        if os.path.exists(thumb_path):
+            return thumb_path
+    return path
+
+def _memory_lock(username):
+    with _memory_locks_guard:
+        lock = _memory_locks.get(username)
+        if lock is None:
+            lock = _memory_locks[username] = threading.RLock()
+        return lock
+
+def _serialize_message(msg):
+    parts = msg["parts"]
     
-    data_to_save = []
-    for msg in history:
-        role = msg["role"]
-        parts = msg["parts"]
+    # Normalize parts to a list
+    if not isinstance(parts, list):
+        parts = [parts]
         
-        # Normalize parts to a list
-        if not isinstance(parts, list):
-            parts = [parts]
-            
-        serializable_parts = []
-        for part in parts:
-            if isinstance(part, str):
-                serializable_parts.append({"type": "text", "text": part})
-            elif isinstance(part, dict):
-                # Pass through structured parts (text or image)
-                serializable_parts.append(part)
-            # We assume images in session state are already handled or won't be saved directly as objects here
-            # In main.py, we should convert PIL images to paths before appending to history for saving
-            
-        data_to_save.append({"role": role, "parts": serializable_parts})
+    serializable_parts = []
+    for part in parts:
+        if isinstance(part, str):
+            serializable_parts.append({"type": "text", "text": part})
+        elif isinstance(part, dict):
+            # Pass through structured parts (text or image)
+            serializable_parts.append(part)
+        # We assume images in session state are already handled or won't be saved directly as objects here
+        # In main.py, we should convert PIL images to paths before appending to history for saving
         
-    with open(os.path.join(user_folder, "memory.json"), "w", encoding="utf-8") as f:
-        json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+    return {"role": msg["role"], "parts": serializable_parts}
 
-def load_memory(username):
-    user_folder = _get_user_folder(username)
-    memory_path = os.path.join(user_folder, "memory.json")
-    if os.path.exists(memory_path):
-        with open(memory_path, "r", encoding="utf-8") as f:
-            try:
-                data = json.load(f)
-                # Convert back to simple format for app usage if needed, 
-                # or adapt app to use structured parts.
-                # For compatibility, we'll keep it structured.
-                return data
-            except:
-                return []
+def message_text(msg, image_text=""):
+    """Joins a message's text parts with spaces; image parts become image_text (skipped when empty)"""
+    # 兼容旧格式：parts 可能是单个字符串，也可能是字符串和字典混合的列表
+    parts = msg["parts"] if isinstance(msg["parts"], list) else [msg["parts"]]
+    texts = []
+    for part in parts:
+        if isinstance(part, dict):
+            texts.append(image_text if part.get("type") == "image" else part.get("text", ""))
+        else:
+            texts.append(str(part))
+    return " ".join(t for t in texts if t)
+
+def message_count(username):
+    return init_storage().message_count(username)
+
+def read_messages(username, start=0, stop=None):
+    """Reads messages [start, stop) using slice semantics, without loading the rest of the history"""
+    return init_storage().read_messages(username, start, stop)
+
+def load_recent(username, limit):
+    """Returns (start_id, messages) for the last `limit` messages"""
+    with _memory_lock(username):
+        start = max(0, message_count(username) - limit)
+        return start, read_messages(username, start)
+
+def load_before(username, before_id, limit):
+    """Returns (start_id, messages) for up to `limit` messages preceding message before_id"""
+    start = max(0, before_id - limit)
+    return start, read_messages(username, start, before_id)
+
+def last_message(username):
+    msgs = read_messages(username, -1)
+    return msgs[0] if msgs else None
+
+def append_message(username, msg):
+    """Durably appends one message and returns its message id (position in history)"""
+    with _memory_lock(username):
+        msg_id = init_storage().append_message(username, _serialize_message(msg))
+    notify.signal(memory_key(username))
+    return msg_id
+
+def memory_key(username):
+    return f"memory:{username}"
+
+def wait_for_messages(username, after_count, timeout, poll_interval=1.0):
+    """Blocks until the history holds more than after_count messages and returns the new ones ([] on timeout)"""
+    # message_count 很便宜 (stat 索引文件 / 主键查询)，其他进程写入时靠轮询兜底
+    if notify.wait_until(memory_key(username), lambda: message_count(username) > after_count, timeout, poll_interval):
+        return read_messages(username, after_count)
     return []
+
+def save_memory(username, history):
+    with _memory_lock(username):
+        count = message_count(username)
+        # 常见情况：history 是已存记录加上新消息，只追加新增部分
+        if count <= len(history) and (count == 0 or last_message(username) == _serialize_message(history[count - 1])):
+            for msg in history[count:]:
+                append_message(username, msg)
+        else:
+            init_storage().replace_messages(username, [_serialize_message(msg) for msg in history])
+            notify.signal(memory_key(username))
+
+def load_summary(username):
+    """Returns the running summary of folded-away history: {"upto": message count covered, "text": ...}"""
+    return init_storage().load_summary(username)
+
+def save_summary(username, summary):
+    init_storage().save_summary(username, summary)
+
+def load_memory(username):
+    try:
+        return read_messages(username)
+    except (OSError, ValueError):
+        return []
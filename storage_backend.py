@@ -0,0 +1,75 @@
+from abc import ABC, abstractmethod
+
+class StorageBackend(ABC):
+    """Persistence interface behind storage.py.
+
+    Implementations: json_backend.JsonBackend (files under data/, the default) and
+    sqlite_backend.SQLiteBackend (LAOJIA_STORAGE=sqlite). Messages handed to the
+    backend are already normalized to {"role": ..., "parts": [dict, ...]}, and
+    message ids are their 0-based position in the user's history.
+    """
+
+    # --- users / tokens ---
+    @abstractmethod
+    def get_user(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_user(self, username, record):
+        """Inserts a user record; returns False if the username is taken"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def update_user(self, username, fields):
+        """Merges fields into an existing user record; returns False if there is no such user"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_usernames(self):
+        raise NotImplementedError
+
+    # --- profiles ---
+    @abstractmethod
+    def load_profile(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_profile(self, username, profile_data):
+        raise NotImplementedError
+
+    # --- messages ---
+    @abstractmethod
+    def append_message(self, username, msg):
+        """Durably appends msg and returns its message id"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def message_count(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_messages(self, username, start=0, stop=None):
+        """Returns messages [start, stop) with slice semantics (negative indices allowed)"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def replace_messages(self, username, messages):
+        """Atomically replaces the whole history"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_summary(self, username):
+        raise NotImplementedError
+
+    @abstractmethod
+    def save_summary(self, username, summary):
+        raise NotImplementedError
+
+    # --- image metadata (the image files themselves stay under data/users/<name>/images) ---
+    @abstractmethod
+    def record_image(self, username, rel_path, meta):
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_images(self, username):
+        raise NotImplementedError
@@ -0,0 +1,47 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import storage
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    monkeypatch.setenv("LAOJIA_SECRET", "test-secret")
+    storage.configure(data_folder=str(tmp_path), backend="json")
+    yield tmp_path
+    storage.configure(data_folder="data", backend="json")
+
+def _add_legacy_token(username):
+    token = uuid.uuid4().hex
+    storage.init_storage().update_user(username, {"token": token})
+    return token
+
+def test_revoked_legacy_token_is_rejected(data_folder):
+    storage.create_user("alice", "pw")
+    token = _add_legacy_token("alice")
+    assert storage.verify_session_token("alice", token)
+
+    assert storage.revoke_session_token(token, "alice")
+    assert not storage.verify_session_token("alice", token)
+    assert storage.exchange_session_token("alice", token) is None
+
+def test_legacy_token_is_exchanged_once(data_folder):
+    storage.create_user("bob", "pw")
+    token = _add_legacy_token("bob")
+
+    signed = storage.exchange_session_token("bob", token)
+    assert signed and signed != token
+    assert storage.verify_session_token("bob", signed)
+    # 旧令牌换过一次就作废
+    assert storage.exchange_session_token("bob", token) is None
+    assert not storage.verify_session_token("bob", token)
+
+def test_signed_token_revocation(data_folder):
+    storage.create_user("carol", "pw")
+    signed = storage.update_session_token("carol")
+    assert storage.exchange_session_token("carol", signed) == signed
+    assert storage.revoke_session_token(signed, "carol")
+    assert not storage.verify_session_token("carol", signed)
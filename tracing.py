@@ -0,0 +1,150 @@
+"""Per-turn latency tracing.
+
+Every phase of a turn (UI, model, TTS, bridge, J1800 bot) is written as one JSON line
+{"ts", "turn", "source", "span", "ms", "ok", ...} to a rotating trace file. Spans that
+belong to the same turn share a turn id, which travels to the bot with the queued request.
+
+    python tracing.py [trace folder]    # percentile summary per (source, span)
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+TRACE_FOLDER = os.environ.get("LAOJIA_TRACE_DIR", os.path.join("data", "traces"))
+TRACE_FILE = "trace.jsonl"
+TRACE_MAX_BYTES = 5 * 1024 * 1024
+TRACE_BACKUPS = 5
+
+_logger = logging.getLogger("laojia.trace")
+_logger.propagate = False
+_logger.setLevel(logging.INFO)
+_handler_lock = threading.Lock()
+
+def _ensure_handler():
+    if _logger.handlers:
+        return
+    with _handler_lock:
+        if not _logger.handlers:
+            os.makedirs(TRACE_FOLDER, exist_ok=True)
+            handler = RotatingFileHandler(os.path.join(TRACE_FOLDER, TRACE_FILE), maxBytes=TRACE_MAX_BYTES,
+                                          backupCount=TRACE_BACKUPS, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            _logger.addHandler(handler)
+
+def new_turn_id():
+    return uuid.uuid4().hex[:12]
+
+def record(turn_id, source, span, duration_ms, ok=True, **fields):
+    """Writes one finished span; tracing must never break a turn, so errors are swallowed"""
+    try:
+        _ensure_handler()
+        entry = {"ts": round(time.time(), 3), "turn": turn_id, "source": source, "span": span,
+                 "ms": round(duration_ms, 2), "ok": ok, **fields}
+        _logger.info(json.dumps(entry, ensure_ascii=False))
+    except Exception:
+        pass
+
+class Turn:
+    """Collects spans for one turn under a shared turn id"""
+    def __init__(self, turn_id=None, source="ui", **fields):
+        self.turn_id = turn_id or new_turn_id()
+        self.source = source
+        self.fields = fields
+        self.started = time.perf_counter()
+        self.spans = [] # 本轮已记录的 span，J1800 随回复一起传回服务端
+
+    @contextmanager
+    def span(self, name, **fields):
+        t0 = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except BaseException:
+            ok = False
+            raise
+        finally:
+            self.record(name, (time.perf_counter() - t0) * 1000, ok, **fields)
+
+    def record(self, name, duration_ms, ok=True, **fields):
+        self.spans.append({"span": name, "ms": round(duration_ms, 2), "ok": ok, **self.fields, **fields})
+        record(self.turn_id, self.source, name, duration_ms, ok, **self.fields, **fields)
+
+    def since(self, name, t0, ok=True, **fields):
+        """Records a span that started at perf_counter value t0 and ends now"""
+        self.record(name, (time.perf_counter() - t0) * 1000, ok, **fields)
+
+    def finish(self, ok=True, **fields):
+        self.since("turn", self.started, ok, **fields)
+
+MAX_REMOTE_SPANS = 50
+
+def record_remote(turn_id, source, spans):
+    """Writes spans reported by another machine (the J1800 bot) into this trace file"""
+    if not isinstance(spans, list):
+        return
+    for span in spans[:MAX_REMOTE_SPANS]:
+        if not isinstance(span, dict) or not isinstance(span.get("span"), str):
+            continue
+        try:
+            duration_ms = float(span["ms"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        fields = {k: v for k, v in span.items() if k not in ("span", "ms", "ok", "ts", "turn", "source")}
+        record(turn_id, source, span["span"], duration_ms, bool(span.get("ok", True)), **fields)
+
+def load_spans(folder=None):
+    folder = folder or TRACE_FOLDER
+    paths = [os.path.join(folder, TRACE_FILE)] + [os.path.join(folder, f"{TRACE_FILE}.{i}") for i in range(1, TRACE_BACKUPS + 1)]
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list (0 for an empty one)"""
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+def summarize(spans):
+    """Aggregates spans into [{source, span, n, errors, p50, p90, p99, max}] (milliseconds)"""
+    groups = {}
+    for s in spans:
+        groups.setdefault((s.get("source", "?"), s.get("span", "?")), []).append(s)
+    rows = []
+    for (source, span), items in sorted(groups.items()):
+        values = sorted(s["ms"] for s in items)
+        rows.append({
+            "source": source,
+            "span": span,
+            "n": len(values),
+            "errors": sum(1 for s in items if not s.get("ok", True)),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1],
+        })
+    return rows
+
+def format_summary(rows):
+    columns = ["source", "span", "n", "errors", "p50", "p90", "p99", "max"]
+    widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) if rows else len(c) for c in columns}
+    lines = ["  ".join(c.ljust(widths[c]) for c in columns)]
+    for r in rows:
+        lines.append("  ".join(str(r[c]).ljust(widths[c]) for c in columns))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    print(format_summary(summarize(load_spans(sys.argv[1] if len(sys.argv) > 1 else None))))
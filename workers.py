@@ -0,0 +1,81 @@
+import atexit
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Streamlit 脚本线程之外的共享后台执行器：
+#   submit_io  —— 有界线程池，处理存盘、图片编码等阻塞 I/O；同一个 lane 的任务按提交顺序执行
+#   run_async  —— 常驻事件循环，跑 edge_tts 这类协程，不再每次 asyncio.run 新建循环
+IO_WORKERS = 4
+MAX_PENDING = 64 # 排队任务上限，满了 submit_io 会阻塞，防止内存无限增长
+
+_io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+_slots = threading.BoundedSemaphore(MAX_PENDING)
+_lanes = {} # lane -> 该 lane 最后提交的 future
+_pending = set()
+_state_lock = threading.Lock()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+def submit_io(fn, *args, lane=None, **kwargs):
+    """Runs fn on the I/O pool and returns a Future.
+
+    Tasks sharing a lane (e.g. a username) run strictly in submission order, so a
+    reply can never be stored before the question it answers.
+    """
+    _slots.acquire()
+    with _state_lock:
+        previous = _lanes.get(lane) if lane is not None else None
+
+        def task():
+            try:
+                if previous is not None:
+                    # 同 lane 的上一个任务先提交，线程池先进先出，不会互相等死
+                    wait([previous])
+                return fn(*args, **kwargs)
+            finally:
+                _slots.release()
+
+        future = _io_pool.submit(task)
+        _pending.add(future)
+        if lane is not None:
+            _lanes[lane] = future
+    future.add_done_callback(_forget(lane))
+    return future
+
+def _forget(lane):
+    def done(future):
+        with _state_lock:
+            _pending.discard(future)
+            if lane is not None and _lanes.get(lane) is future:
+                del _lanes[lane]
+        # 没人等结果的任务 (比如回复落盘) 出错时至少留个记录
+        if not future.cancelled() and future.exception() is not None:
+            print(f"⚠️ 后台任务失败: {future.exception()!r}")
+    return done
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="async-loop", daemon=True).start()
+        return _loop
+
+def run_async(coro):
+    """Schedules a coroutine on the shared event loop and returns a concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+def flush(timeout=None):
+    """Blocks until every queued I/O task has finished"""
+    with _state_lock:
+        pending = list(_pending)
+    wait(pending, timeout=timeout)
+
+@atexit.register
+def shutdown():
+    flush(timeout=30)
+    _io_pool.shutdown(wait=True)
+    if _loop is not None:
+        _loop.call_soon_threadsafe(_loop.stop)